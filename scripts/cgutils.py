@@ -0,0 +1,98 @@
+import json
+import array
+import itertools
+
+# XXX: Callgraph helpers that only import the standard library at module
+#      level. stitch.py imports the analyzed packages in-process from the
+#      sysdir, so any third-party module it imported itself (numpy, orjson,
+#      ...) would already sit in sys.modules and shadow the sysdir copy.
+#      Keep it that way: heavier dependencies belong in utils.
+
+
+def compact_dumps(obj):
+    return json.dumps(obj, separators=(',', ':')).encode()
+
+def json_default(obj):
+    # XXX: Serialize EdgeArrays (and numpy arrays) as lists of [src, dst]
+    tolist = getattr(obj, 'tolist', None)
+    if tolist is not None:
+        return tolist()
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
+
+def stream_dump_graph(graph, outfile, dumps=compact_dumps, chunk=1 << 16):
+    # XXX: Compact JSON for {key: {idx: node}, key: [edge, ...]} documents,
+    #      serialized a chunk of items at a time instead of as one giant
+    #      string. outfile must be opened in binary mode.
+    outfile.write(b'{')
+    for n, (key, value) in enumerate(graph.items()):
+        if n > 0:
+            outfile.write(b',')
+        outfile.write(dumps(str(key)) + b':')
+        if isinstance(value, dict):
+            items = (dumps(str(k)) + b':' + dumps(v) for k, v in value.items())
+            opening, closing = b'{', b'}'
+        elif isinstance(value, (list, EdgeArray)):
+            items = (dumps(v) for v in value)
+            opening, closing = b'[', b']'
+        else:
+            outfile.write(dumps(value))
+            continue
+        outfile.write(opening)
+        first = True
+        while True:
+            parts = list(itertools.islice(items, chunk))
+            if not parts:
+                break
+            if not first:
+                outfile.write(b',')
+            outfile.write(b','.join(parts))
+            first = False
+        outfile.write(closing)
+    outfile.write(b'}')
+
+class EdgeArray:
+    # XXX: Callgraph edges as flat, growable int32 (src, dst) pairs: 8 bytes
+    #      per edge instead of a 2-element list of ints. array() exposes
+    #      them to numpy as an (n, 2) view without copying. With unique=True,
+    #      repeated (src, dst) pairs are dropped, keeping the first one.
+    #      numpy is only imported by the methods that need it.
+    def __init__(self, unique=False):
+        self.flat = array.array('i')
+        self.seen = set() if unique else None
+
+    def append(self, src, dst):
+        if self.seen is not None:
+            key = (src << 32) | dst
+            if key in self.seen:
+                return
+            self.seen.add(key)
+        self.flat.append(src)
+        self.flat.append(dst)
+
+    def extend(self, pairs):
+        import numpy as np
+        pairs = np.asarray(pairs, dtype=np.int32).reshape(-1, 2)
+        if self.seen is not None:
+            keys = (pairs[:, 0].astype(np.int64) << 32) | pairs[:, 1]
+            _, first = np.unique(keys, return_index=True)
+            first.sort()
+            seen = self.seen
+            keep = [i for i, k in zip(first.tolist(), keys[first].tolist()) if k not in seen]
+            seen.update(keys[keep].tolist())
+            pairs = pairs[keep]
+        self.flat.frombytes(pairs.tobytes())
+
+    def array(self):
+        import numpy as np
+        return np.frombuffer(self.flat, dtype=np.int32).reshape(-1, 2)
+
+    def tolist(self):
+        return list(self)
+
+    def __len__(self):
+        return len(self.flat) // 2
+
+    def __iter__(self):
+        flat = iter(self.flat)
+        for src, dst in zip(flat, flat):
+            yield [src, dst]
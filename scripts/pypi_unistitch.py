@@ -565,8 +565,8 @@ class UnifiedStitcher():
 
             unified_cg = unifier.unify()
             utils.create_dir(self.unified_cg_dir)
-            with open(self.unified_cg_path, 'w') as outfile:
-                outfile.write(json.dumps(unified_cg, indent=2))
+            with open(self.unified_cg_path, 'wb', buffering=1 << 20) as outfile:
+                utils.stream_dump_graph(unified_cg, outfile)
         except Exception as e:
             log.error(f'Failed to Unify callgraph for package {self.package}')
             return -1
@@ -1,10 +1,13 @@
 import os
+import re
 import sys
+import csv
 import json
+import hashlib
+import collections
 import argparse
 import logging
-from pathlib import Path
-import shutil
+import functools
 from multiprocessing import cpu_count, Pool
 import concurrent.futures
 import tempfile
@@ -12,6 +15,9 @@ import tempfile
 import starbinstitch
 import utils
 
+# XXX: Number of package specs handed to a single batched pip invocation
+BATCH_SIZE = 32
+
 log = logging.getLogger(__name__)
 
 def setup_logging(args):
@@ -58,11 +64,19 @@ def parse_args():
         action='store_true',
         help=("Always generate artifacts, never reuse existing stuff."),
     )
+    p.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=cpu_count(),
+        help=("Number of packages to process in parallel."),
+    )
     return p.parse_args()
 
 class FullSBS():
-    def __init__(self, package, version, always):
+    def __init__(self, package, version, always, toplevel_ready=False):
         self.always = always
+        self.toplevel_ready = toplevel_ready
         self.package = package
         self.version = version
         self.git_root = utils.find_git_root()
@@ -79,6 +93,9 @@ class FullSBS():
         self.sb_root = os.path.join(self.git_root, 'data/star_bridges')
         self.sb_dir = os.path.join(self.sb_root, self.namesnip)
         self.sb_path = os.path.join(self.sb_dir, 'starbridges.json')
+        self.sb_sig_path = os.path.join(self.sb_dir, '.sig')
+        self.install_sig_path = self.tmp_install_dir + '.sig'
+        self.wheel_cache = os.path.join(self.git_root, 'data/wheel_cache')
 
         self.top_levels = None
         self.naked = None
@@ -86,7 +103,7 @@ class FullSBS():
 
     def find_toplevels(self):
         log.info(f"Finding top_level import names for {self.package}:{self.version}")
-        if os.path.exists(self.tmp_install_dir_toplevel) and not self.always:
+        if os.path.exists(self.tmp_install_dir_toplevel) and (self.toplevel_ready or not self.always):
             log.info(f"Temp TOPLEVEL install dir for {self.package}:{self.version} already exists at {self.tmp_install_dir_toplevel} - Skipping...")
             log.info(f"Use -A to force recreation.")
         else:
@@ -94,16 +111,18 @@ class FullSBS():
                 utils.create_dir(self.tmp_install_dir_toplevel)
             except FileExistsError as e:
                 log.warning(e)
+            spec = "{}=={}".format(self.package, self.version)
+            cached = utils.download_spec_to_cache(self.wheel_cache, spec, ['--no-deps']) == 0
             cmd = [
                 'pip3',
                 'install',
                 '-t', self.tmp_install_dir_toplevel,
                 '--no-build-isolation',
                 '--no-deps',
-                "{}=={}".format(self.package, self.version)
+                spec
             ]
             try:
-                ret, out, err = utils.run_cmd(cmd)
+                ret, out, err = utils.run_pip_install(cmd, self.wheel_cache, cached)
             except Exception as e:
                 log.error(e)
                 raise
@@ -112,23 +131,25 @@ class FullSBS():
                 log.debug(out)
                 log.debug(err)
                 if os.path.exists(self.tmp_install_dir_toplevel):
-                    shutil.rmtree(self.tmp_install_dir_toplevel)
+                    utils.async_rmtree(self.tmp_install_dir_toplevel)
                 return ret
 
-        root_path = Path(self.tmp_install_dir_toplevel)
-        top_levels = [
-            os.path.basename(str(subdir)) for subdir in root_path.iterdir()
-            if subdir.is_dir() and (subdir / '__init__.py').exists()
-        ]
-        first_comps = [
-            os.path.basename(str(subdir)) for subdir in root_path.iterdir()
-        ]
+        top_levels = []
+        first_comps = []
+        naked = []
+        with os.scandir(self.tmp_install_dir_toplevel) as it:
+            for e in it:
+                first_comps.append(e.name)
+                if e.is_dir(follow_symlinks=False):
+                    if os.path.exists(os.path.join(e.path, '__init__.py')):
+                        top_levels.append(e.name)
+                # elif e.name.endswith('.py') or e.name.endswith('.so'):
+                elif e.name.endswith('.so'):
+                    naked.append(e.name)
         self.first_comps = first_comps
         log.debug(f'FIRST_COMPS = {self.first_comps}')
         if len(top_levels) > 0:
             self.top_levels = [os.path.join(self.tmp_install_dir, tl) for tl in top_levels]
-        # naked = [item for item in os.listdir(self.tmp_install_dir_toplevel) if item.endswith('.py') or item.endswith('.so')]
-        naked = [item for item in os.listdir(self.tmp_install_dir_toplevel) if item.endswith('.so')]
         if len(naked) > 0:
             self.naked = [os.path.join(self.tmp_install_dir, n) for n in naked]
         log.debug(f"top_levels for {self.package}:{self.version} are {self.top_levels}")
@@ -139,25 +160,33 @@ class FullSBS():
 
     def install_package(self):
         log.info(f"Installing package {self.package}:{self.version} and deps in {self.tmp_install_dir}")
-        if os.path.exists(self.tmp_install_dir) and not self.always:
+        install_sig = hashlib.blake2b(f"{self.package}=={self.version}\n{pip_version()}".encode(), digest_size=16).hexdigest()
+        stored_sig = read_sig(self.install_sig_path)
+        if os.path.exists(self.tmp_install_dir) and not self.always and stored_sig in (None, install_sig):
+            if stored_sig is None:
+                write_sig(self.install_sig_path, install_sig)
             log.info(f"Temp install dir for {self.package}:{self.version} already exists at {self.tmp_install_dir} - Skipping...")
             log.info(f"Use -A to force recreation.")
             return 0
         else:
+            if os.path.exists(self.tmp_install_dir) and not self.always:
+                log.info(f"pip changed since {self.tmp_install_dir} was installed - Reinstalling...")
             try:
                 utils.create_dir(self.tmp_install_dir)
             except FileExistsError as e:
                 log.warning(e)
+            spec = "{}=={}".format(self.package, self.version)
+            cached = utils.download_spec_to_cache(self.wheel_cache, spec, ['--no-binary', 'Pillow']) == 0
             cmd = [
                 'pip3',
                 'install',
                 '-t', self.tmp_install_dir,
                 '--no-binary', 'Pillow',
                 '--upgrade', '--force-reinstall',
-                "{}=={}".format(self.package, self.version)
+                spec
             ]
             try:
-                ret, out, err = utils.run_cmd(cmd)
+                ret, out, err = utils.run_pip_install(cmd, self.wheel_cache, cached)
             except Exception as e:
                 log.error(e)
                 raise
@@ -169,17 +198,27 @@ class FullSBS():
                 log.info(out)
                 log.info(err)
                 if os.path.exists(self.tmp_install_dir):
-                    shutil.rmtree(self.tmp_install_dir)
+                    utils.async_rmtree(self.tmp_install_dir)
                 return ret
 
+            write_sig(self.install_sig_path, install_sig)
             return 0
 
     def generate_starbridges(self):
         log.info(f"Generating starbridges for {self.package}:{self.version}")
-        if os.path.exists(self.sb_path) and not self.always:
+        # XXX: Only reuse the bridges if the install tree they were generated
+        #      from is unchanged. Bridges from before signatures were recorded
+        #      are trusted as-is.
+        tree_sig = tree_signature(self.tmp_install_dir)
+        stored_sig = read_sig(self.sb_sig_path)
+        if os.path.exists(self.sb_path) and not self.always and stored_sig in (None, tree_sig):
+            if stored_sig is None:
+                write_sig(self.sb_sig_path, tree_sig)
             log.info(f"Bridges file for {self.package}:{self.version} already exists at {self.sb_path} - Skipping...")
             log.info(f"Use -A to force recreation.")
         else:
+            if os.path.exists(self.sb_path) and not self.always:
+                log.info(f"Install tree of {self.package}:{self.version} changed since {self.sb_path} was generated - Regenerating...")
             try:
                 utils.create_dir(self.sb_dir)
             except FileExistsError as e:
@@ -218,18 +257,26 @@ class FullSBS():
                 log.debug(err)
                 return ret
 
+            # XXX: The analyzer imports from the tree, so take the signature afterwards
+            write_sig(self.sb_sig_path, tree_signature(self.tmp_install_dir))
+
         return 0
 
     def process(self):
         log.info(f"Processing package: {self.package}:{self.version}")
 
-        ret = self.find_toplevels()
-        if ret != 0:
-            return ret
+        # XXX: The TOPLEVEL and the full install go to different dirs and
+        #      neither reads the other's output, so overlap the two pip runs.
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            f_toplevels = executor.submit(self.find_toplevels)
+            f_install = executor.submit(self.install_package)
+            ret_toplevels = f_toplevels.result()
+            ret_install = f_install.result()
 
-        ret = self.install_package()
-        if ret != 0:
-            return ret
+        if ret_toplevels != 0:
+            return ret_toplevels
+        if ret_install != 0:
+            return ret_install
 
         ret = self.generate_starbridges()
         if ret != 0:
@@ -237,11 +284,151 @@ class FullSBS():
 
         return ret
 
-def do_single(p, always):
+@functools.lru_cache(maxsize=None)
+def pip_version():
+    ret, out, err = utils.run_cmd(['pip3', '--version'])
+    return out.strip()
+
+def tree_signature(root):
+    # XXX: Cheap change detection: hash (relpath, size, mtime) of every file.
+    #      Bytecode caches come and go with imports, so leave them out.
+    entries = []
+    for e in utils.walk_files(root):
+        if '/__pycache__/' in e.path:
+            continue
+        st = e.stat(follow_symlinks=False)
+        entries.append((os.path.relpath(e.path, start=root), st.st_size, st.st_mtime_ns))
+    h = hashlib.blake2b(digest_size=16)
+    for rel, size, mtime in sorted(entries):
+        h.update(f"{rel}\0{size}\0{mtime}\n".encode())
+    return h.hexdigest()
+
+def read_sig(path):
+    try:
+        with open(path, 'r') as infile:
+            return infile.read().strip()
+    except FileNotFoundError:
+        return None
+
+def write_sig(path, sig):
+    with open(path, 'w') as outfile:
+        outfile.write(sig)
+
+def do_single(p, always, toplevel_ready=False):
     # log.info(f"Processing package {p}")
     (name,version) = utils.pkg_name_to_tuple(p)
-    fullsbs = FullSBS(name, version, always)
-    fullsbs.process()
+    fullsbs = FullSBS(name, version, always, toplevel_ready)
+    return fullsbs.process()
+
+def canonical_name(name):
+    return re.sub(r"[-_.]+", "-", name).lower()
+
+def staged_record(staging, fullsbs):
+    # XXX: `pip install -t` uses the home scheme, so RECORD paths are relative
+    #      to <home>/lib/python and scripts show up as ../../bin/<script>.
+    #      Returns the paths relative to staging, or None if the package is
+    #      not in the staging dir.
+    dist_info = None
+    for item in os.listdir(staging):
+        if not item.endswith('.dist-info'):
+            continue
+        name, _, version = item[:-len('.dist-info')].partition('-')
+        if canonical_name(name) == canonical_name(fullsbs.package) and version == fullsbs.version:
+            dist_info = os.path.join(staging, item)
+            break
+    if dist_info is None:
+        log.warning(f"No dist-info for {fullsbs.package}:{fullsbs.version} in batch staging dir {staging}")
+        return None
+
+    with open(os.path.join(dist_info, 'RECORD'), 'r', newline='') as infile:
+        record = [row[0] for row in csv.reader(infile) if row]
+
+    rels = []
+    for path in record:
+        rel = os.path.normpath(os.path.join('lib/python', path))
+        if rel.startswith('lib/python/'):
+            rel = rel[len('lib/python/'):]
+        rels.append(rel)
+    return rels
+
+def split_staged(staging, fullsbs, record):
+    for rel in record:
+        src = os.path.join(staging, rel)
+        if not os.path.lexists(src):
+            continue
+        dst = os.path.join(fullsbs.tmp_install_dir_toplevel, rel)
+        utils.create_dir(os.path.dirname(dst))
+        os.replace(src, dst)
+
+def install_toplevel_batch(batch):
+    staging = tempfile.mkdtemp(prefix='batch_', dir=batch[0].tmp_install_dir_root)
+    try:
+        cmd = [
+            'pip3',
+            'install',
+            '-t', staging,
+            '--no-build-isolation',
+            '--no-deps',
+        ]
+        cmd.extend(["{}=={}".format(f.package, f.version) for f in batch])
+        ret, out, err = utils.run_cmd(cmd)
+        if ret != 0:
+            log.warning(f"Batched TOPLEVEL install of {len(batch)} packages failed, falling back to per-package installs")
+            log.debug(err)
+            return set()
+
+        # XXX: Packages of a batch share the staging dir, so a path shipped by
+        #      more than one of them (e.g. a top-level tests/__init__.py) holds
+        #      only the last install's copy. Leave such packages to the
+        #      per-package installs instead of splitting them from here.
+        records = [staged_record(staging, f) for f in batch]
+        owners = collections.Counter(rel for record in records if record is not None for rel in set(record))
+
+        ready = set()
+        for f, record in zip(batch, records):
+            if record is None:
+                continue
+            shared = [rel for rel in record if owners[rel] > 1]
+            if shared:
+                log.warning(f"{f.package}:{f.version} shares {len(shared)} paths (e.g. {shared[0]}) with other packages of its batch, installing it separately")
+                continue
+            if os.path.exists(f.tmp_install_dir_toplevel):
+                utils.async_rmtree(f.tmp_install_dir_toplevel)
+            split_staged(staging, f, record)
+            ready.add(f.package + ':' + f.version)
+        return ready
+    finally:
+        utils.async_rmtree(staging)
+
+def batch_install_toplevels(package_names, always, jobs):
+    # XXX: The --no-deps TOPLEVEL installs do not interfere with each other,
+    #      so install many of them with a single pip run (one resolver/interpreter
+    #      startup) and split the result per package using each wheel's RECORD.
+    #      A spec cannot appear twice with different versions in one pip run,
+    #      so keep names unique per batch.
+    batches = []
+    for p in package_names:
+        (name, version) = utils.pkg_name_to_tuple(p)
+        f = FullSBS(name, version, always)
+        if os.path.exists(f.tmp_install_dir_toplevel) and not always:
+            continue
+        for b in batches:
+            if len(b) < BATCH_SIZE and all(canonical_name(o.package) != canonical_name(name) for o in b):
+                b.append(f)
+                break
+        else:
+            batches.append([f])
+
+    if not batches:
+        return set()
+
+    utils.create_dir(batches[0][0].tmp_install_dir_root)
+    ready = set()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(jobs, len(batches)))) as executor:
+        for r in executor.map(install_toplevel_batch, batches):
+            ready.update(r)
+    log.info(f"Batch-installed TOPLEVEL trees for {len(ready)} packages")
+    return ready
 
 def main():
     args = parse_args()
@@ -254,11 +441,27 @@ def main():
     package_names = utils.load_csv(args.input)
     # log.info(f"package_names = {package_names}")
 
-    # with concurrent.futures.ProcessPoolExecutor(max_workers=6) as executor:
-    #     for pkg in package_names:
-    #         executor.submit(do_single, pkg, args.always)
+    git_root = utils.find_git_root()
+    if git_root is not None:
+        utils.purge_trash(os.path.join(git_root, 'data/install'))
+        utils.purge_trash(os.path.join(git_root, 'data/wheel_cache'))
+
+    toplevel_ready = batch_install_toplevels(package_names, args.always, args.jobs)
+
+    failures = 0
+    max_workers = max(1, min(args.jobs, len(package_names)))
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futs = {executor.submit(do_single, pkg, args.always, pkg in toplevel_ready): pkg for pkg in package_names}
+        for f in concurrent.futures.as_completed(futs):
+            try:
+                ret = f.result()
+            except Exception as e:
+                log.error(f"Failed processing {futs[f]}: {e}")
+                ret = -1
+            if ret != 0:
+                failures += 1
 
-    for pkg in package_names:
-        do_single(pkg, args.always)
+    if failures:
+        log.error(f"Done with failures: {failures}")
 if __name__ == "__main__":
     main()
@@ -4,7 +4,23 @@ import sys
 import json
 import argparse
 import logging
-import networkx as nx
+import itertools
+import numpy as np
+
+import utils
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# XXX: FASTEN URI: ...!<name>$<version>/...
+#      [^$]+ instead of a lazy .+? keeps matching linear.
+FASTEN_URI_RE = re.compile(r'!([^$]+)\$([^/]+)/')
+
+# XXX: Unified callgraphs at least this large are streamed with ijson (when
+#      available) rather than loaded whole. Below it orjson is faster.
+STREAM_THRESHOLD = 100 * 1024 * 1024
 
 log = logging.getLogger(__name__)
 
@@ -64,12 +80,19 @@ def parse_args():
         action='store_true',
         help=("Indicates that unified CG is in FASTEN format."),
     )
+    p.add_argument(
+        "--pretty",
+        default=False,
+        action='store_true',
+        help=("Indent the output callgraph for human inspection."),
+    )
     return p.parse_args()
 
 class ReachabilityDetector:
-    def __init__(self, package, unified_cg_path, output, fasten):
+    def __init__(self, package, unified_cg_path, output, fasten, pretty=False):
         self.package = package
         self.fasten = fasten
+        self.pretty = pretty
         if ':' in self.package:
             self.pypi = True
         elif '/' in self.package:
@@ -85,95 +108,140 @@ class ReachabilityDetector:
 
         self.output = output
 
-        self.graph = None
+        self.num_nodes = 0
+        self.indptr = None
+        self.indices = None
+        self.edges = None
         self.entrypoints = None
-        self.reachable_idxs = set()
+        self.idx_keys = []
+        self.reachable_idxs = frozenset()
+        self.reachable_mask = None
 
         self.final_callgraph = {'nodes': {}, 'edges': []}
-        self.n2idx = {}
-        self.idx2n = {}
-        self.n2pkg = {}
 
 
     def generate_final_callgraph(self):
-        for idx, v in self.callgraph['nodes'].items():
-            if int(idx) in self.reachable_idxs:
-                self.final_callgraph['nodes'][idx] = self.callgraph['nodes'][idx]
-        for e in self.callgraph['edges']:
-            src = e[0]
-            dst = e[1]
-            if src in self.reachable_idxs and dst in self.reachable_idxs:
-                self.final_callgraph['edges'].append(e)
-            elif (src in self.reachable_idxs and not dst in self.reachable_idxs):
-                log.warning(f'dst of edge {e} is not in reachable nodes while src is')
+        # XXX: Usually only a fraction of the nodes is reachable, so look the
+        #      reachable ones up instead of filtering every node.
+        if self.callgraph is None:
+            # Streaming: only the reachable nodes are ever held in memory
+            reach = self.reachable_idxs
+            nodes = {k: v for k, v in self.iter_nodes() if int(k) in reach}
+        else:
+            nodes_map = self.callgraph['nodes']
+            idx_keys = self.idx_keys
+            n_keys = len(idx_keys)
+            nodes = {idx_keys[i]: nodes_map[idx_keys[i]] for i in np.flatnonzero(self.reachable_mask).tolist() if i < n_keys and idx_keys[i] is not None}
+        src_in = self.reachable_mask[self.edges[:, 0]]
+        dst_in = self.reachable_mask[self.edges[:, 1]]
+        self.final_callgraph = {
+            'nodes': nodes,
+            'edges': self.edges[src_in & dst_in].tolist(),
+        }
+
+        dangling = src_in & ~dst_in
+        if dangling.any():
+            log.warning(f'dst of {int(dangling.sum())} edges is not in reachable nodes while src is, e.g. {self.edges[dangling][0].tolist()}')
 
 
     def load_callgraph(self):
-        with open(self.unified_cg_path, 'r') as infile:
-            self.callgraph = json.loads(infile.read())
+        if ijson is not None and os.path.getsize(self.unified_cg_path) >= STREAM_THRESHOLD:
+            log.info(f'Streaming {self.unified_cg_path} instead of loading it')
+            self.callgraph = None
+            return
+        with open(self.unified_cg_path, 'rb') as infile:
+            self.callgraph = utils.json_load(infile)
+
+    def iter_nodes(self):
+        if self.callgraph is not None:
+            yield from self.callgraph["nodes"].items()
+            return
+        with open(self.unified_cg_path, 'rb') as infile:
+            yield from ijson.kvitems(infile, 'nodes')
+
+    def load_edges(self):
+        if self.callgraph is not None:
+            return np.asarray(self.callgraph["edges"], dtype=np.int64).reshape(-1, 2)
+        with open(self.unified_cg_path, 'rb') as infile:
+            flat = itertools.chain.from_iterable(ijson.items(infile, 'edges.item'))
+            return np.fromiter(flat, dtype=np.int64).reshape(-1, 2)
 
     def calculate_reachable(self):
-        for idx in self.entrypoints:
-            idxs = nx.descendants(self.graph, idx)
-            self.reachable_idxs.update(idxs)
-            self.reachable_idxs.add(idx)
-
-    def find_entrypoints(self):
-        entrypoints=set()
-
-        for n, p in self.n2pkg.items():
-            if p == self.package:
-                entrypoints.add(self.n2idx[n])
-
-        self.entrypoints = entrypoints
-
+        # XXX: One level-synchronous BFS from all entrypoints at once over the
+        #      CSR adjacency, instead of one nx.descendants() per entrypoint.
+        visited = np.zeros(self.num_nodes, dtype=bool)
+        frontier = np.fromiter(self.entrypoints, dtype=np.int64, count=len(self.entrypoints))
+        visited[frontier] = True
+        while len(frontier) > 0:
+            starts = self.indptr[frontier]
+            lens = self.indptr[frontier + 1] - starts
+            # Positions of all out-edges of the frontier in self.indices
+            offsets = np.repeat(starts - np.cumsum(lens) + lens, lens) + np.arange(lens.sum())
+            succs = self.indices[offsets]
+            frontier = np.unique(succs[~visited[succs]])
+            visited[frontier] = True
+
+        self.reachable_mask = visited
+        self.reachable_idxs = frozenset(np.flatnonzero(visited).tolist())
 
     def uri2package_fasten(self, text):
-        match = re.search(r'!(.+?)\$([^/]+)/', text)
+        match = FASTEN_URI_RE.search(text)
         if match:
             name = match.group(1)
             version = match.group(2)
         else:
-            log.error(f"Could not parse URI {uri}")
+            log.error(f"Could not parse URI {text}")
             return -1
 
         return(name,version)
 
     def create_graph(self):
-        graph = nx.DiGraph()
-        for idxstr, v in self.callgraph["nodes"].items():
+        # XXX: Only integer indices are needed downstream, so collect the
+        #      entrypoints (Python nodes of self.package) in the same pass
+        #      instead of building name <-> idx maps.
+        num_nodes = 0
+        entrypoints = []
+        # Original key of each node, indexed by node idx (None for gaps)
+        idx_keys = []
+        for idxstr, v in self.iter_nodes():
             idx = int(idxstr)
-            name = v["name"]
-            library = v.get('library', None)
-            uri = (name, library)
-
-            if library is None:
-                if 'package' not in v.keys():
+            if v.get('library', None) is None:
+                pkg = v.get('package', None)
+                if pkg is None:
                     log.error(f'node with idx {idx} and value {v} has neither library nor package')
                     raise RuntimeError
-                pkg = v["package"]
-                self.n2pkg[name] = pkg
-
-            self.idx2n[idx] = name
-            self.n2idx[name] = idx
-            graph.add_node(idx)
-
-        self.graph = graph
-
-        for edge in self.callgraph["edges"]:
-            graph.add_edge(edge[0], edge[1])
+                if pkg == self.package:
+                    entrypoints.append(idx)
+            if idx >= num_nodes:
+                idx_keys.extend([None] * (idx + 1 - num_nodes))
+                num_nodes = idx + 1
+            idx_keys[idx] = idxstr
+        self.entrypoints = entrypoints
+        self.idx_keys = idx_keys
+
+        # XXX: Node indices are (nearly) dense, so use them directly as CSR
+        #      row numbers: successors of u are indices[indptr[u]:indptr[u+1]].
+        edges = self.load_edges()
+        if len(edges) > 0:
+            num_nodes = max(num_nodes, int(edges.max()) + 1)
+        src = edges[:, 0]
+        order = np.argsort(src, kind='stable')
+        self.indices = edges[order, 1]
+        self.indptr = np.zeros(num_nodes + 1, dtype=np.int64)
+        np.cumsum(np.bincount(src, minlength=num_nodes), out=self.indptr[1:])
+        self.num_nodes = num_nodes
+        self.edges = edges
 
     def reach(self):
         self.load_callgraph()
         self.create_graph()
-        self.find_entrypoints()
         log.info(f'Entrypoints for {self.package}: {len(self.entrypoints)}')
         self.calculate_reachable()
         self.generate_final_callgraph()
 
         if self.output is not None:
-            with open(self.output, 'w') as outfile:
-                outfile.write(json.dumps(self.final_callgraph, indent=2))
+            with open(self.output, 'wb') as outfile:
+                utils.json_dump(self.final_callgraph, outfile, indent=self.pretty)
             log.info(f'Wrote reached callgraph to {self.output}')
         else:
             log.info(json.dumps(self.final_callgraph, indent=2))
@@ -191,7 +259,7 @@ def main():
         log.error("Must provide callgraph to process")
         sys.exit(1)
 
-    reacher = ReachabilityDetector(args.package, args.callgraph, args.output, args.fasten)
+    reacher = ReachabilityDetector(args.package, args.callgraph, args.output, args.fasten, args.pretty)
     reacher.reach()
 
 
@@ -3,9 +3,9 @@ import sys
 import json
 import logging
 import argparse
+from multiprocessing import cpu_count
 
 import concurrent.futures
-from pathlib import Path
 
 import utils
 import reach_sane
@@ -64,11 +64,19 @@ def parse_args():
         action='store_true',
         help=("Always process callgraphs."),
     )
+    p.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=cpu_count(),
+        help=("Number of callgraphs to process in parallel."),
+    )
     return p.parse_args()
 
 class FullReachability_G():
-    def __init__(self, always):
+    def __init__(self, always, jobs):
         self.always = always
+        self.jobs = jobs
         self.git_root = utils.find_git_root()
         if self.git_root is None:
             log.error(f"CWD is outside Xray git repo.")
@@ -83,10 +91,16 @@ class FullReachability_G():
         self.cg2pkg = {}
 
     def find_callgraphs(self):
-        self.cg_paths = [str(path) for path in Path(self.unified_cg_root).rglob("*")
-                         if path.is_file()
-                         and path.name == 'unified.json']
-        for inpath in self.cg_paths:
+        # XXX: cg2out doubles as the seen-set for the duplicate check
+        self.cg_paths = []
+        for e in utils.walk_files(self.unified_cg_root):
+            if e.name != 'unified.json':
+                continue
+            inpath = e.path
+            if inpath in self.cg2out:
+                log.error(f'CG_PATHS CONTAIN DUPLICATES: {inpath}')
+                continue
+            self.cg_paths.append(inpath)
             namesnip = os.path.relpath(os.path.dirname(inpath), start=self.unified_cg_root)
             outpath = os.path.join(self.reached_cg_root, namesnip, 'reached.json')
             self.cg2out[inpath] = outpath
@@ -98,20 +112,22 @@ class FullReachability_G():
         self.find_callgraphs()
         log.info(self.cg_paths)
         log.info(f'len(cg_paths) = {len(self.cg_paths)}')
-        if len(self.cg_paths) != len(set(self.cg_paths)):
-            log.error('CG_PATHS CONTAIN DUPLICATES')
 
+        todo = []
         for cg in self.cg_paths:
             if os.path.exists(self.cg2out[cg]) and not self.always:
                 log.info(f'Reached cg for {self.cg2pkg[cg]} already exists at {self.cg2out[cg]}. Use -A to force rerun')
             else:
                 utils.create_dir(os.path.dirname(self.cg2out[cg]))
-                do_single(self.cg2pkg[cg], cg, self.cg2out[cg])
+                todo.append(cg)
+
+        run_parallel(todo, self.cg2pkg, self.cg2out, self.jobs)
 
 
 class FullReachability_P():
-    def __init__(self, always):
+    def __init__(self, always, jobs):
         self.always = always
+        self.jobs = jobs
         self.git_root = utils.find_git_root()
         if self.git_root is None:
             log.error(f"CWD is outside Xray git repo.")
@@ -125,12 +141,16 @@ class FullReachability_P():
         self.cg2pkg = {}
 
     def find_callgraphs(self):
-        self.cg_paths = [str(path) for path in Path(self.unified_cg_root).rglob("*")
-                         if path.is_file()
-                         and path.name == 'unified.json'
-                         and '/apps/' not in str(path)]
-
-        for inpath in self.cg_paths:
+        # XXX: cg2out doubles as the seen-set for the duplicate check
+        self.cg_paths = []
+        for e in utils.walk_files(self.unified_cg_root):
+            if e.name != 'unified.json' or '/apps/' in e.path:
+                continue
+            inpath = e.path
+            if inpath in self.cg2out:
+                log.error(f'CG_PATHS CONTAIN DUPLICATES: {inpath}')
+                continue
+            self.cg_paths.append(inpath)
             namesnip = os.path.relpath(os.path.dirname(inpath), start=self.unified_cg_root)
             outpath = os.path.join(self.reached_cg_root, namesnip, 'reached.json')
             self.cg2out[inpath] = outpath
@@ -142,18 +162,28 @@ class FullReachability_P():
         self.find_callgraphs()
         log.info(self.cg_paths)
         log.info(f'len(cg_paths) = {len(self.cg_paths)}')
-        if len(self.cg_paths) != len(set(self.cg_paths)):
-            log.error('CG_PATHS CONTAIN DUPLICATES')
 
         for cg in self.cg_paths:
             utils.create_dir(os.path.dirname(self.cg2out[cg]))
-            do_single(self.cg2pkg[cg], cg, self.cg2out[cg])
+
+        run_parallel(self.cg_paths, self.cg2pkg, self.cg2out, self.jobs)
 
 def do_single(package, inpath, outpath):
     log.info(f'do_single({package}, {inpath}, {outpath})')
     reacher = reach_sane.ReachabilityDetector(package, inpath, outpath, False)
     reacher.reach()
 
+def run_parallel(cg_paths, cg2pkg, cg2out, jobs):
+    # XXX: Reachability is CPU-bound pure Python, so use processes, not threads.
+    max_workers = max(1, min(jobs, len(cg_paths)))
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futs = {executor.submit(do_single, cg2pkg[cg], cg, cg2out[cg]): cg for cg in cg_paths}
+        for f in concurrent.futures.as_completed(futs):
+            try:
+                f.result()
+            except Exception as e:
+                log.error(f'Failed processing {futs[f]}: {e}')
+
 def main():
     args = parse_args()
     setup_logging(args)
@@ -162,9 +192,9 @@ def main():
         log.error(f"Must provide one of '-G', '-P' arguments")
         sys.exit(1)
     if args.pypi:
-        fr = FullReachability_P(args.always)
+        fr = FullReachability_P(args.always, args.jobs)
     elif args.github:
-        fr = FullReachability_G(args.always)
+        fr = FullReachability_G(args.always, args.jobs)
 
     fr.process()
 
@@ -3,10 +3,25 @@ import sys
 import json
 import argparse
 import logging
+from multiprocessing import cpu_count
 import concurrent.futures
 
 import utils
 
+# XXX: pipdeptree's internals are private and differ completely between
+#      releases (4.x has a Rust core, 2.x is pure Python). Use whichever is
+#      importable and fall back to the CLI otherwise.
+try:
+    from pipdeptree._rust import execute as pipdeptree_execute
+except ImportError:
+    pipdeptree_execute = None
+try:
+    from pipdeptree._discovery import get_installed_distributions
+    from pipdeptree._models import PackageDAG
+except ImportError:
+    get_installed_distributions = None
+    PackageDAG = None
+
 log = logging.getLogger(__name__)
 
 def setup_logging(args):
@@ -53,6 +68,13 @@ def parse_args():
         action='store_true',
         help=("Always generate artifacts, never reuse existing stuff."),
     )
+    p.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=cpu_count(),
+        help=("Number of packages to process in parallel."),
+    )
     return p.parse_args()
 
 
@@ -107,36 +129,47 @@ class DependencyResolver():
             log.info(f'Tmp install dir already exists... Skipping install')
         return 0
 
+    def pipdeptree_json(self):
+        # XXX: Output of `pipdeptree --path <dir> --json`, computed in-process
+        #      to spare a fresh interpreter per package.
+        argv = ['--path', self.tmp_install_dir, '--json']
+        try:
+            if pipdeptree_execute is not None:
+                code, out, err, _ = pipdeptree_execute(argv, color=False, terminal_width=None)
+                if code == 0:
+                    return json.loads(out)
+                log.warning(f'In-process pipdeptree returned {code}: {err}')
+            elif get_installed_distributions is not None:
+                dists = get_installed_distributions(supplied_paths=[self.tmp_install_dir])
+                dag = PackageDAG.from_pkgs(dists)
+                return [{'package': k.as_dict(), 'dependencies': [d.as_dict() for d in deps]}
+                        for k, deps in dag.items()]
+        except Exception as e:
+            log.warning(f'In-process pipdeptree failed ({e}), falling back to the CLI')
+
+        ret, out, err = utils.run_cmd(['pipdeptree'] + argv)
+        return json.loads(out)
+
     def resolve_deps(self):
         log.info(f'Resolving dependencies for {self.package}')
-        cmd = [
-            'pipdeptree',
-            '--path', self.tmp_install_dir,
-            '--json'
-        ]
         try:
-            ret, out, err = utils.run_cmd(cmd)
+            deps_raw = self.pipdeptree_json()
         except Exception as e:
             log.error(e)
             log.error('bad')
             return -1
 
-        deps_raw = json.loads(out)
         deps_direct = {}
         deps_all = set()
-        for entry in deps_raw:
-            p = entry['package']
-            dependencies = entry['dependencies']
-            if p['package_name'] == self.name and p['installed_version'] == self.version:
-                deps_direct = [{'name': d['package_name'], 'required_version': d['required_version']} for d in dependencies]
         for entry in deps_raw:
             p = entry['package']
             name = p['package_name']
+            version = p['installed_version']
             if name == self.name:
+                if version == self.version:
+                    deps_direct = [{'name': d['package_name'], 'required_version': d['required_version']} for d in entry['dependencies']]
                 continue
-            version = p['installed_version']
-            pkgver = name + ':' + version
-            deps_all.add(pkgver)
+            deps_all.add(name + ':' + version)
 
         self.deps_all = list(deps_all)
         self.deps_direct = deps_direct
@@ -145,15 +178,17 @@ class DependencyResolver():
 
     def save_deps(self):
         utils.create_dir(self.deps_dir)
-        with open(self.deps_direct_path, 'w') as outfile:
-            outfile.write(json.dumps(self.deps_direct, indent=2))
+        # XXX: These are small and meant to be read by humans, keep them indented
+        with open(self.deps_direct_path, 'wb') as outfile:
+            utils.json_dump(self.deps_direct, outfile)
 
         log.info(f'Wrote direct deps to {self.deps_direct_path}')
 
-        with open(self.deps_all_path, 'w') as outfile:
-            outfile.write(json.dumps(self.deps_all, indent=2))
+        with open(self.deps_all_path, 'wb') as outfile:
+            utils.json_dump(self.deps_all, outfile)
 
         log.info(f'Wrote all deps to {self.deps_all_path}')
+        return 0
 
     def process(self):
         ret = self.install()
@@ -171,10 +206,11 @@ class DependencyResolver():
         if ret != 0:
             return ret
 
+        return 0
 
 def do_single(package, always):
     depresolver = DependencyResolver(package, always)
-    depresolver.process()
+    return depresolver.process()
 
 def main():
     args = parse_args()
@@ -187,9 +223,21 @@ def main():
     packages = utils.load_csv(args.input)
     log.info(f"packages = {packages}")
 
+    failures = 0
+    max_workers = max(1, min(args.jobs, len(packages)))
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futs = {executor.submit(do_single, pkg, args.always): pkg for pkg in packages}
+        for f in concurrent.futures.as_completed(futs):
+            try:
+                ret = f.result()
+            except Exception as e:
+                log.error(f"Failed processing {futs[f]}: {e}")
+                ret = -1
+            if ret != 0:
+                failures += 1
 
-    for pkg in packages:
-        do_single(pkg, args.always)
+    if failures:
+        log.error(f"Done with failures: {failures}")
 
 if __name__ == "__main__":
     main()
@@ -1,18 +1,28 @@
 import os
 import sys
 import json
+import hashlib
+import contextlib
 import argparse
 import logging
-from pathlib import Path
 import shutil
+import multiprocessing
 from multiprocessing import cpu_count, Pool
 import concurrent.futures
 import tempfile
+import threading
 
 import starbinstitch
 import utils
 
 PRV_PYHIDRA_ROOT = '/prv-pyhidra-cg'
+# XXX: Bump when ghidra_pyhidra_callgraphs.py changes its output, so that
+#      cached binary callgraphs are not reused.
+GHIDRA_SCRIPT_VERSION = '1'
+# XXX: main() runs MAX_WORKERS packages at once and each of them runs its
+#      Ghidra subprocesses in a pool of its own. Split the CPUs between them.
+MAX_WORKERS = min(6, cpu_count())
+BINCG_WORKERS = max(1, cpu_count() // MAX_WORKERS)
 
 log = logging.getLogger(__name__)
 
@@ -60,19 +70,29 @@ def parse_args():
         action='store_true',
         help=("Always generate artifacts, never reuse existing stuff."),
     )
+    p.add_argument(
+        "--pretty",
+        default=False,
+        action='store_true',
+        help=("Indent the output SBS callgraphs for human inspection."),
+    )
     return p.parse_args()
 
 class FullSBS():
-    def __init__(self, package, version, always):
+    def __init__(self, package, version, always, pretty=False):
         self.always = always
+        self.pretty = pretty
         self.package = package
         self.version = version
         self.git_root = utils.find_git_root()
         self.namesnip = package[0] + '/' + package + '/' + version
+        # XXX: Same layout as the other stages, so that the install trees are
+        #      shared with them. The locks and the TOPLEVEL meta go next to them.
         self.tmp_install_dir_root = os.path.join(self.git_root, 'data/install')
         self.tempinst_uuid = package + '___' + version
         self.tmp_install_dir = os.path.join(self.tmp_install_dir_root, self.tempinst_uuid)
         self.tmp_install_dir_toplevel = os.path.join(self.tmp_install_dir_root, self.tempinst_uuid + '___TOPLEVEL')
+        self.toplevel_meta_path = os.path.join(self.tmp_install_dir_root, self.tempinst_uuid + '___TOPLEVEL.meta.json')
         if self.git_root is None:
             log.error(f"CWD is outside Xray git repo.")
             return
@@ -84,6 +104,8 @@ class FullSBS():
 
         self.bcg_root = os.path.join(self.git_root, 'data/binary_callgraphs')
         self.bcg_dir = os.path.join(self.bcg_root, self.namesnip)
+        self.bcg_cache_root = os.path.join(self.git_root, 'data/bincg_cache')
+        self.wheel_cache = os.path.join(self.git_root, 'data/wheel_cache')
 
         self.sbs_dir = os.path.join(self.git_root, 'data/sbs', self.namesnip)
         self.sbs_path = os.path.join(self.sbs_dir, 'sbs.json')
@@ -99,47 +121,37 @@ class FullSBS():
 
     def find_toplevels(self):
         log.info(f"Finding top_level import names for {self.package}:{self.version}")
-        if os.path.exists(self.tmp_install_dir_toplevel) and not self.always:
-            log.warning(f"Temp TOPLEVEL install dir for {self.package}:{self.version} already exists at {self.tmp_install_dir_toplevel} - Skipping...")
-            log.info(f"Use -A to force recreation.")
-        else:
-            try:
-                utils.create_dir(self.tmp_install_dir_toplevel)
-            except FileExistsError as e:
-                log.warning(e)
-            cmd = [
-                'pip3',
-                'install',
-                '-t', self.tmp_install_dir_toplevel,
-                '--no-deps',
-                "{}=={}".format(self.package, self.version)
-            ]
-            try:
-                ret, out, err = utils.run_cmd(cmd)
-            except Exception as e:
-                log.error(e)
-                raise
-            if ret != 0:
-                log.error(f"cmd {cmd} returned non-zero exit code {ret}")
-                log.info(out)
-                log.info(err)
-                if os.path.exists(self.tmp_install_dir_toplevel):
-                    shutil.rmtree(self.tmp_install_dir_toplevel)
-                return ret
+        with utils.locked(self.tmp_install_dir_toplevel):
+            if os.path.exists(self.toplevel_meta_path) and not self.always:
+                log.info(f"Top-level names for {self.package}:{self.version} cached at {self.toplevel_meta_path} - Skipping...")
+                with open(self.toplevel_meta_path, 'rb') as infile:
+                    meta = utils.json_load(infile)
+                top_levels = meta['top_levels']
+                naked = meta['naked']
+                first_comps = meta['first_comps']
+            else:
+                ret = self.install_toplevel()
+                if ret != 0:
+                    return ret
+
+                top_levels = []
+                first_comps = []
+                naked = []
+                with os.scandir(self.tmp_install_dir_toplevel) as it:
+                    for e in it:
+                        first_comps.append(e.name)
+                        if e.is_dir(follow_symlinks=False):
+                            if os.path.exists(os.path.join(e.path, '__init__.py')):
+                                top_levels.append(e.name)
+                        elif e.name.endswith('.py') or e.name.endswith('.so'):
+                            naked.append(e.name)
+                with open(self.toplevel_meta_path, 'wb') as outfile:
+                    utils.json_dump({'top_levels': top_levels, 'naked': naked, 'first_comps': first_comps}, outfile)
 
-        root_path = Path(self.tmp_install_dir_toplevel)
-        top_levels = [
-            os.path.basename(str(subdir)) for subdir in root_path.iterdir()
-            if subdir.is_dir() and (subdir / '__init__.py').exists()
-        ]
-        first_comps = [
-            os.path.basename(str(subdir)) for subdir in root_path.iterdir()
-        ]
         self.first_comps = first_comps
         log.info(f'FIRST_COMPS = {self.first_comps}')
         if len(top_levels) > 0:
             self.top_levels = [os.path.join(self.tmp_install_dir, tl) for tl in top_levels]
-        naked = [item for item in os.listdir(self.tmp_install_dir_toplevel) if item.endswith('.py') or item.endswith('.so')]
         if len(naked) > 0:
             self.naked = [os.path.join(self.tmp_install_dir, n) for n in naked]
         log.info(f"top_levels for {self.package}:{self.version} are {self.top_levels}")
@@ -148,42 +160,58 @@ class FullSBS():
 
         return 0
 
+    def install_toplevel(self):
+        if os.path.exists(self.tmp_install_dir_toplevel) and not self.always:
+            log.warning(f"Temp TOPLEVEL install dir for {self.package}:{self.version} already exists at {self.tmp_install_dir_toplevel} - Skipping...")
+            log.info(f"Use -A to force recreation.")
+            return 0
+        return self.pip_install(self.tmp_install_dir_toplevel, ['--no-deps'], ['--no-deps'])
+
     def install_package(self):
+        with utils.locked(self.tmp_install_dir):
+            return self.install_package_locked()
+
+    def install_package_locked(self):
         log.info(f"Installing package {self.package}:{self.version} and deps in {self.tmp_install_dir}")
         if os.path.exists(self.tmp_install_dir) and not self.always:
             log.warning(f"Temp install dir for {self.package}:{self.version} already exists at {self.tmp_install_dir} - Skipping...")
             log.info(f"Use -A to force recreation.")
             return 0
-        else:
-            try:
-                utils.create_dir(self.tmp_install_dir)
-            except FileExistsError as e:
-                log.warning(e)
-            cmd = [
-                'pip3',
-                'install',
-                '-t', self.tmp_install_dir,
-                '--no-binary', 'Pillow',
-                '--upgrade', '--force-reinstall',
-                "{}=={}".format(self.package, self.version)
-            ]
-            try:
-                ret, out, err = utils.run_cmd(cmd)
-            except Exception as e:
-                log.error(e)
-                raise
+        return self.pip_install(self.tmp_install_dir,
+                                ['--no-binary', 'Pillow'],
+                                ['--no-binary', 'Pillow', '--upgrade', '--force-reinstall'])
+
+    def pip_install(self, target, download_args, install_args):
+        try:
+            utils.create_dir(target)
+        except FileExistsError as e:
+            log.warning(e)
+        spec = "{}=={}".format(self.package, self.version)
+        cached = utils.download_spec_to_cache(self.wheel_cache, spec, download_args) == 0
+        # XXX: Only .py/.so files are analyzed, so do not byte-compile the
+        #      tree. (PIP_NO_COMPILE=1 would *enable* compilation, as pip
+        #      reads it as the value of the compile option.)
+        cmd = [
+            'pip3',
+            'install',
+            '-t', target,
+            '--no-compile',
+        ]
+        cmd.extend(install_args)
+        cmd.append(spec)
+        try:
+            ret, out, err = utils.run_pip_install(cmd, self.wheel_cache, cached)
+        except Exception as e:
+            log.error(e)
+            raise
+        if ret != 0:
+            log.error(f"cmd {cmd} returned non-zero exit code {ret}")
             log.info(out)
             log.info(err)
-
-            if ret != 0:
-                log.error(f"cmd {cmd} returned non-zero exit code {ret}")
-                log.info(out)
-                log.info(err)
-                if os.path.exists(self.tmp_install_dir):
-                    shutil.rmtree(self.tmp_install_dir)
-                return ret
-
-            return 0
+            if os.path.exists(target):
+                shutil.rmtree(target)
+            return ret
+        return 0
 
     def generate_starbridges(self):
         log.info(f"Generating starbridges for {self.package}:{self.version}")
@@ -243,7 +271,23 @@ class FullSBS():
             log.info(f"Use -A to force recreation.")
             return 0
 
-        with tempfile.TemporaryDirectory() as temp_dir:
+        # XXX: The same .so often ships unchanged across versions, so key a
+        #      cache on its contents. The lib name goes into the key as well,
+        #      since it is passed to (and recorded by) the Ghidra script.
+        h = hashlib.sha256(f"{GHIDRA_SCRIPT_VERSION}\0{lib}\0".encode())
+        h.update(bytes.fromhex(file_sha256(binary_path)))
+        key = h.hexdigest()
+        cache_path = os.path.join(self.bcg_cache_root, key[:2], key + '.json')
+        if os.path.exists(cache_path):
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+            copy_atomic(cache_path, output_path)
+            log.info(f"Reused cached call graph of {binary_path} from {cache_path}")
+            return 0
+
+        # XXX: Ghidra's scratch project goes to the default tempdir. Set
+        #      PYXRAY_TMPDIR (e.g. to /dev/shm) to put it on tmpfs instead,
+        #      where there is room (Docker's default /dev/shm is only 64MB).
+        with tempfile.TemporaryDirectory(dir=os.environ.get('PYXRAY_TMPDIR')) as temp_dir:
             cmd = [
                 'python3',
                 os.path.join(PRV_PYHIDRA_ROOT, 'ghidra_pyhidra_callgraphs.py'),
@@ -265,12 +309,18 @@ class FullSBS():
                 return ret
 
         log.info(f"Stored binary cg at: {output_path}")
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        copy_atomic(output_path, cache_path)
         return 0
 
     def find_all_libs(self):
-        root = Path(self.tmp_install_dir)
-        all_libs_absolute = [p.resolve().as_posix().strip() for p in root.glob("**/*") if p.suffix == ".so" or ".so." in p.name]
-        self.all_libs = [os.path.relpath(p, start=self.tmp_install_dir) for p in all_libs_absolute]
+        # XXX: walk_files() does not descend into dir symlinks, so below the
+        #      canonical root only symlinked files need a realpath().
+        root = os.path.realpath(self.tmp_install_dir)
+        all_libs_absolute = [os.path.realpath(e.path) if e.is_symlink() else e.path
+                             for e in utils.walk_files(root)
+                             if e.name.endswith('.so') or '.so.' in e.name]
+        self.all_libs = [os.path.relpath(p, start=root) for p in all_libs_absolute]
 
         return 0
 
@@ -278,9 +328,10 @@ class FullSBS():
         log.info(f"Generating binary callgraphs of all libs from {self.package}:{self.version}")
         log.info(f'NUM_LIBS: {len(self.all_libs)}')
 
+        first_comps = tuple(self.first_comps)
+        naked = set(self.naked or ())
         for lib in self.all_libs:
-            if (any([lib.startswith(fc) for fc in self.first_comps])
-                or (self.naked and any([lib == n for n in self.naked]))):
+            if lib.startswith(first_comps) or lib in naked:
                 binary_path = os.path.join(self.tmp_install_dir, lib)
                 bcg_trail = lib + '.json'
                 bcg_path = os.path.join(self.bcg_dir, bcg_trail)
@@ -291,10 +342,18 @@ class FullSBS():
 
         log.info(self.bcg_paths)
 
-        for lib in self.all_libs:
-            if lib in self.lib2bcg.keys():
-                ret = self.do_bincg_single(lib)
+        # XXX: Each lib is a separate, independent Ghidra subprocess, so run
+        #      them side by side. Threads are enough: they just wait on run_cmd.
+        libs = [lib for lib in self.all_libs if lib in self.lib2bcg and not os.path.exists(self.lib2bcg[lib])]
+        if not libs:
+            log.info(f"All binary callgraphs of {self.package}:{self.version} already exist - Skipping...")
+            return 0
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(BINCG_WORKERS, len(libs))) as executor:
+            futs = [executor.submit(self.do_bincg_single, lib) for lib in libs]
+            for f in concurrent.futures.as_completed(futs):
+                ret = f.result()
                 if ret != 0:
+                    executor.shutdown(wait=True, cancel_futures=True)
                     return ret
 
         return 0
@@ -308,7 +367,7 @@ class FullSBS():
             utils.create_dir(self.sbs_dir)
         except FileExistsError as e:
             log.warning(e)
-        mech = starbinstitch.StarBinStitcher(self.sb_path, self.sbs_path, self.bcg_paths)
+        mech = starbinstitch.StarBinStitcher(self.sb_path, self.sbs_path, self.bcg_paths, self.pretty)
         mech.stitch()
         log.info(f"Stored SBS of {self.package}:{self.version} at {self.sbs_path}")
         return 0
@@ -317,13 +376,26 @@ class FullSBS():
     def process(self):
         log.info(f"Processing package: {self.package}:{self.version}")
 
-        ret = self.find_toplevels()
-        if ret != 0:
-            return ret
+        # XXX: The SBS is the last artifact, so if it is there nothing before
+        #      it needs to run (installs, lib discovery, Ghidra).
+        if os.path.exists(self.sbs_path) and not self.always:
+            log.info(f"SBS for {self.package}:{self.version} already exists at {self.sbs_path} - Skipping...")
+            log.info(f"Use -A to force recreation.")
+            return 0
 
-        ret = self.install_package()
-        if ret != 0:
-            return ret
+        # XXX: The TOPLEVEL and the full install go to different dirs (under
+        #      different locks) and neither reads the other's output, so
+        #      overlap the two pip runs.
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            f_toplevels = executor.submit(self.find_toplevels)
+            f_install = executor.submit(self.install_package)
+            ret_toplevels = f_toplevels.result()
+            ret_install = f_install.result()
+
+        if ret_toplevels != 0:
+            return ret_toplevels
+        if ret_install != 0:
+            return ret_install
 
         ret = self.generate_starbridges()
         if ret != 0:
@@ -340,11 +412,45 @@ class FullSBS():
         ret = self.generate_sbs()
         return ret
 
-def do_single(p, always):
+def file_sha256(path):
+    with open(path, 'rb') as infile:
+        if hasattr(hashlib, 'file_digest'):
+            return hashlib.file_digest(infile, 'sha256').hexdigest()
+        h = hashlib.sha256()
+        for chunk in iter(lambda: infile.read(1 << 20), b''):
+            h.update(chunk)
+        return h.hexdigest()
+
+def copy_atomic(src, dst):
+    # XXX: Always a real copy, never a hardlink: later stages rewrite the
+    #      binary callgraphs in place (see utils.bincg_add_fun_suffix), which
+    #      must not reach the cache. The rename keeps readers from seeing a
+    #      partial file.
+    tmp = f'{dst}.tmp.{os.getpid()}.{threading.get_ident()}'
+    try:
+        shutil.copyfile(src, tmp)
+        os.replace(tmp, dst)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tmp)
+        raise
+
+def do_single(p, always, pretty=False):
     log.info(f"Processing package {p}")
     (name,version) = utils.pkg_name_to_tuple(p)
-    fullsbs = FullSBS(name, version, always)
-    fullsbs.process()
+    fullsbs = FullSBS(name, version, always, pretty)
+    return fullsbs.process()
+
+def check_result(fut, pkg):
+    try:
+        ret = fut.result()
+    except Exception as e:
+        log.error(f"Failed processing {pkg}: {e}")
+        return 1
+    if ret != 0:
+        log.error(f"Processing {pkg} returned {ret}")
+        return 1
+    return 0
 
 def main():
     args = parse_args()
@@ -357,9 +463,30 @@ def main():
     package_names = utils.load_csv(args.input)
     log.info(f"package_names = {package_names}")
 
-    with concurrent.futures.ProcessPoolExecutor(max_workers=6) as executor:
+    git_root = utils.find_git_root()
+    if git_root is not None:
+        utils.purge_trash(os.path.join(git_root, 'data/wheel_cache'))
+
+    # XXX: Keep at most 2 * MAX_WORKERS packages in flight instead of queueing
+    #      a future per CSV line up front. forkserver workers start from a
+    #      clean interpreter, so set up their logging explicitly.
+    failures = 0
+    max_pending = 2 * MAX_WORKERS
+    mp_context = multiprocessing.get_context('forkserver')
+    with concurrent.futures.ProcessPoolExecutor(max_workers=MAX_WORKERS, mp_context=mp_context,
+                                                initializer=setup_logging, initargs=(args,)) as executor:
+        pending = {}
         for pkg in package_names:
-            executor.submit(do_single, pkg, args.always)
+            if len(pending) >= max_pending:
+                done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for f in done:
+                    failures += check_result(f, pending.pop(f))
+            pending[executor.submit(do_single, pkg, args.always, args.pretty)] = pkg
+        for f in concurrent.futures.as_completed(pending):
+            failures += check_result(f, pending[f])
+
+    if failures:
+        log.error(f"Done with failures: {failures}")
 
 if __name__ == "__main__":
     main()
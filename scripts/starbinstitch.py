@@ -3,20 +3,24 @@ import json
 import argparse
 import logging
 from collections import defaultdict
-import networkx as nx
+import numpy as np
+
+import utils
 
 log = logging.getLogger(__name__)
 
 class StarBinStitcher():
-    def __init__(self, starfile, output_file, socg_files):
+    def __init__(self, starfile, output_file, socg_files, pretty=False):
         self.starfile = starfile
+        self.pretty = pretty
         self.socg_files = socg_files
         self.output_file = output_file
         self.bridges_not_found = []
         self.socgs = []
         self.bridges = []
         self.next_index = 0
-        self.nodes = {}
+        # Indices are dense and handed out in order, so node idx == list position
+        self.nodes = []
         self.edges = []
         self.final_nodes = {}
         self.final_edges = []
@@ -25,8 +29,9 @@ class StarBinStitcher():
         self.entrypoints = set()
         self.final_callgraph = {'nodes': {}, 'edges': []}
 
-        self.egress_per_name_per_lib = defaultdict(dict)
+        self.egress_per_name_per_lib = defaultdict(lambda: defaultdict(int))
         self.reachable_idxs = set()
+        self.adj = None
 
     def get_and_bump_idx(self):
         ret = self.next_index
@@ -34,14 +39,19 @@ class StarBinStitcher():
         return ret
 
     def load_starfile(self):
-        with open(self.starfile, 'r') as infile:
-            sb = json.loads(infile.read())
+        sb = utils.load_json(self.starfile)
         self.bridges = sb['bridges']
 
     def load_socgs(self):
-        for f in self.socg_files:
-            with open(f, 'r') as infile:
-                socg_raw = json.loads(infile.read())
+        # XXX: Hot loops, so use local aliases instead of attribute lookups
+        n2idx = self.n2idx
+        idx2n = self.idx2n
+        nodes_out = self.nodes
+        edges_out = self.edges
+        epln = self.egress_per_name_per_lib
+        # XXX: Read the files ahead on a few threads. They come back in order,
+        #      which keeps the indices stable.
+        for _, socg_raw in utils.iter_load_json(self.socg_files):
             nodes = socg_raw['nodes']
             library = socg_raw['library']
 
@@ -49,43 +59,39 @@ class StarBinStitcher():
 
             for k, v in nodes.items():
                 name = v['name']
-                log.info(f'name = {name}')
-                if name not in self.n2idx.keys():
+                log.debug('name = %s', name)
+                if name not in n2idx:
                     new_node = {'name': name, 'library': library}
                     new_idx = self.get_and_bump_idx()
-                    self.nodes[str(new_idx)] = new_node
-                    self.n2idx[name] = new_idx
-                    self.idx2n[new_idx] = name
-                    old2new[int(k)] = new_idx
-                else:
-                    old2new[int(k)] = self.n2idx[name]
-                self.egress_per_name_per_lib[name][library] = 0
-
-            for e in socg_raw['edges']:
-                src = e[0]
-                dst = e[1]
-                newsrc = old2new[src]
-                newdst = old2new[dst]
-                srcname = self.idx2n[newsrc]
-                self.edges.append([newsrc, newdst])
-                if library in self.egress_per_name_per_lib[srcname].keys():
-                    self.egress_per_name_per_lib[srcname][library] += 1
+                    nodes_out.append(new_node)
+                    n2idx[name] = new_idx
+                    idx2n[new_idx] = name
                 else:
-                    self.egress_per_name_per_lib[srcname][library] = 1
+                    new_idx = n2idx[name]
+                # Keep the name too, so that edges need no idx2n lookup
+                old2new[int(k)] = (new_idx, name)
+                # XXX: Keep the explicit 0: decide_final_libs() looks at every
+                #      lib defining the name, including ones with no egress.
+                epln[name][library] = 0
+
+            for src, dst in socg_raw['edges']:
+                newsrc, srcname = old2new[src]
+                edges_out.append([newsrc, old2new[dst][0]])
+                epln[srcname][library] += 1
 
 
     def process_starfile(self):
         for b in self.bridges:
             pyname = b['pyname']
             cfunc = b['cfunc']
-            if cfunc not in self.n2idx.keys():
+            if cfunc not in self.n2idx:
                 log.warn(f'cfunc {cfunc} from starfile {self.starfile} not found in any binary callgraph')
                 self.bridges_not_found.append(b)
             else:
-                if pyname not in self.n2idx.keys():
+                if pyname not in self.n2idx:
                     new_node = {'name': pyname, 'package': 'PYTHON'}
                     new_idx = self.get_and_bump_idx()
-                    self.nodes[str(new_idx)] = new_node
+                    self.nodes.append(new_node)
                     self.n2idx[pyname] = new_idx
                     self.idx2n[new_idx] = pyname
                 else:
@@ -95,57 +101,61 @@ class StarBinStitcher():
 
 
     def decide_final_libs(self):
-        for idx, node in self.nodes.items():
-            if 'library' in node.keys():
-                name = node['name']
-                lib = node['library']
-                sorted_epln = sorted(self.egress_per_name_per_lib[name].items(), key=lambda item: item[1])
-                if sorted_epln[0][1] == -1:
-                    final_library = sorted_epln[0][0]
-                else:
-                    final_library = sorted_epln[-1][0]
-                final_library = sorted_epln[0][0]
-                self.nodes[idx]['library'] = final_library
+        # XXX: A name defined in several libs is attributed to the lib with
+        #      the fewest outgoing edges for it (first one on ties).
+        final_lib_by_name = {name: min(d, key=d.get)
+                             for name, d in self.egress_per_name_per_lib.items()}
+        for node in self.nodes:
+            if 'library' in node:
+                node['library'] = final_lib_by_name[node['name']]
 
     def calculate_reachable(self):
-        for idx in self.entrypoints:
-            idxs = nx.descendants(self.graph, idx)
-            self.reachable_idxs.update(idxs)
-            self.reachable_idxs.add(idx)
+        # XXX: One traversal from all entrypoints at once, instead of one
+        #      nx.descendants() per entrypoint.
+        adj = self.adj
+        visited = set(self.entrypoints)
+        stack = list(self.entrypoints)
+        while stack:
+            u = stack.pop()
+            for v in adj[u]:
+                if v not in visited:
+                    visited.add(v)
+                    stack.append(v)
+        self.reachable_idxs = visited
 
     def create_graph(self):
-        graph = nx.DiGraph()
-        for idxstr, v in self.callgraph["nodes"].items():
-            idx = int(idxstr)
+        for idx, v in enumerate(self.callgraph["nodes"]):
             name = v["name"]
             library = v.get('library', None)
 
             if library is None:
-                if 'package' not in v.keys():
+                if 'package' not in v:
                     log.error(f'node with idx {idx} and value {v} has neither library nor package')
                     raise RuntimeError
                 pkg = v["package"]
 
             self.idx2n[idx] = name
             self.n2idx[name] = idx
-            graph.add_node(idx)
-
-        self.graph = graph
 
-        for edge in self.callgraph["edges"]:
-            graph.add_edge(edge[0], edge[1])
+        adj = [[] for _ in range(self.next_index)]
+        for src, dst in self.callgraph["edges"]:
+            adj[src].append(dst)
+        self.adj = adj
 
     def generate_final_callgraph(self):
-        for idx, v in self.callgraph['nodes'].items():
-            if int(idx) in self.reachable_idxs:
-                self.final_callgraph['nodes'][idx] = self.callgraph['nodes'][idx]
-        for e in self.callgraph['edges']:
-            src = e[0]
-            dst = e[1]
-            if src in self.reachable_idxs and dst in self.reachable_idxs:
-                self.final_callgraph['edges'].append(e)
-            elif (src in self.reachable_idxs and not dst in self.reachable_idxs):
-                log.warning(f'dst of edge {e} is not in reachable nodes while src is')
+        reach = frozenset(self.reachable_idxs)
+        # The on-disk schema keys nodes by their stringified idx
+        self.final_callgraph['nodes'] = {str(i): v for i, v in enumerate(self.callgraph['nodes']) if i in reach}
+
+        edges = np.asarray(self.callgraph['edges'], dtype=np.int64).reshape(-1, 2)
+        reach_mask = np.zeros(self.next_index, dtype=bool)
+        reach_mask[np.fromiter(reach, dtype=np.int64, count=len(reach))] = True
+        src_in = reach_mask[edges[:, 0]]
+        dst_in = reach_mask[edges[:, 1]]
+        self.final_callgraph['edges'] = edges[src_in & dst_in].tolist()
+        dangling = src_in & ~dst_in
+        if dangling.any():
+            log.warning(f'dst of {int(dangling.sum())} edges is not in reachable nodes while src is, e.g. {edges[dangling][0].tolist()}')
 
     def stitch(self):
         self.load_starfile()
@@ -167,5 +177,5 @@ class StarBinStitcher():
         if self.output_file is None:
             log.info(json.dumps(self.final_callgraph, indent=2))
         else:
-            with open(self.output_file, 'w') as outfile:
-                outfile.write(json.dumps(self.final_callgraph, indent=2))
+            with open(self.output_file, 'wb') as outfile:
+                utils.json_dump(self.final_callgraph, outfile, indent=self.pretty)
@@ -1,20 +1,27 @@
 import os
+import re
 import sys
+import array
 import json
 import argparse
 import logging
 import inspect
+import functools
 
 import importlib
 
 from stdlib_list import stdlib_list
 
+# XXX: Not utils, whose third-party imports would shadow the sysdir (see cgutils)
+import cgutils
+
 STD_MODULES = stdlib_list('.'.join(sys.version.split('.')[:2]))
-STD_MODULE_PREFIXES = [ m + '.' for m in STD_MODULES ]
+STD_MODULES_SET = frozenset(STD_MODULES)
 
-STR_METHOD_SUFFIXES = [ i for i in dir(str) if not i.startswith('__') ]
+STR_METHOD_SUFFIXES = tuple(i for i in dir(str) if not i.startswith('__'))
 
 BUGGY_PREFIXES = ['numpy.distutils']
+BUGGY_RE = re.compile('|'.join(re.escape(p) for p in BUGGY_PREFIXES))
 
 
 log = logging.getLogger(__name__)
@@ -79,22 +86,69 @@ def parse_args():
         default=None,
         help=("Provide stats output file path"),
     )
+    p.add_argument(
+        "--pretty",
+        default=False,
+        action='store_true',
+        help=("Indent the output callgraph for human inspection."),
+    )
     return p.parse_args()
 
 
+@functools.lru_cache(maxsize=100_000)
 def get_import_name_pairs(import_name):
-    parts = import_name.split(".")
+    # XXX: (prefix, suffix) split at every dot, walking the dot positions
+    #      instead of re-joining split parts for each pair.
     pairs = []
+    i = import_name.find('.')
+    while i != -1:
+        pairs.append((import_name[:i], import_name[i + 1:]))
+        i = import_name.find('.', i + 1)
+    return tuple(pairs)
+
+@functools.lru_cache(maxsize=100_000)
+def candidate_names(extname):
+    # XXX: extname itself, plus extname with any str method name stripped
+    #      off its end (PyCG may attach those to the wrong receiver). Most
+    #      names end in none of them, which a single endswith() settles.
+    if not extname.endswith(STR_METHOD_SUFFIXES):
+        return (extname,)
+    names = [extname]
+    for s in STR_METHOD_SUFFIXES:
+        if extname.endswith(s):
+            stripped = extname[:-len(s)]
+            if stripped not in names:
+                names.append(stripped)
+    return tuple(names)
+
+# XXX: The same prefixes (numpy, numpy.core, ...) are tried for thousands of
+#      names. Remember the outcome, including failures (None), so that each
+#      module is imported, or fails to import, only once.
+@functools.lru_cache(maxsize=None)
+def cached_import(m):
+    module = sys.modules.get(m)
+    if module is not None:
+        return module
+    try:
+        return importlib.import_module(m)
+    except Exception as e:
+        log.debug(e)
+        return None
 
-    for i in range(1, len(parts)):
-        prefix = ".".join(parts[:i])
-        suffix = ".".join(parts[i:])
-        pairs.append((prefix, suffix))
-    return pairs
-
+def is_std_name(name):
+    # XXX: Same as any(name.startswith(m + '.') for m in STD_MODULES), but
+    #      with one set lookup per dotted prefix of name.
+    i = name.find('.')
+    while i != -1:
+        if name[:i] in STD_MODULES_SET:
+            return True
+        i = name.find('.', i + 1)
+    return False
+
+@functools.lru_cache(maxsize=100_000)
 def mod_path_to_fqn(mod_path, root_dir):
     if os.path.commonpath([mod_path, root_dir]) != root_dir:
-        log.debug(f'mod_path {mod_path} is not subdirectory of {root_dir}')
+        log.debug('mod_path %s is not subdirectory of %s', mod_path, root_dir)
         return None
     if mod_path.endswith('__init__.py'):
         mod_path = os.path.dirname(mod_path)
@@ -114,8 +168,9 @@ def mod_path_to_fqn(mod_path, root_dir):
 
 
 class MyStitcher():
-    def __init__(self, cg_paths, tl2pkg_path, output_file, sysdir_path, stats_file):
+    def __init__(self, cg_paths, tl2pkg_path, output_file, sysdir_path, stats_file, pretty=False):
         self.sysdir_path = sysdir_path
+        self.pretty = pretty
         self.cg_paths = set(cg_paths)
         self.tl2pkg_path = tl2pkg_path
         self.output_file = output_file
@@ -125,7 +180,7 @@ class MyStitcher():
         self.cgs = []
 
         self.final_nodes = {}
-        self.final_edges = []
+        self.final_edges = cgutils.EdgeArray(unique=True)
         self.next_index = 0
         self.n2idx = {}
         self.idx2n = {}
@@ -147,9 +202,18 @@ class MyStitcher():
 
         if tl2pkg_path is not None:
             with open(tl2pkg_path, 'r') as infile:
-                tl2pkg_raw = json.loads(infile.read())
+                tl2pkg_raw = json.load(infile)
             for tl, pkg in tl2pkg_raw.items():
-                self.tl2pkg[tl] = pkg.split
+                self.tl2pkg[tl] = pkg
+
+        # XXX: Top-level modules that can be imported from the sysdir. Objects
+        #      under any other top-level module cannot map to a stitched node,
+        #      so pyname_to_fqn() does not import them at all. The sysdir is
+        #      listed too, as tl2pkg leaves out namespace packages.
+        self.known_toplevels = None
+        if sysdir_path is not None and os.path.isdir(sysdir_path):
+            self.known_toplevels = set(self.tl2pkg)
+            self.known_toplevels.update(e.split('.')[0] for e in os.listdir(sysdir_path))
 
     def get_and_bump_idx(self):
         ret = self.next_index
@@ -161,18 +225,22 @@ class MyStitcher():
             if not os.path.exists(p):
                 raise RuntimeError(f'Call graph at provided path {p} does not exist!')
             with open(p, 'r') as infile:
-                cg = json.loads(infile.read())
+                cg = json.load(infile)
             self.cgs.append(cg)
 
 
     def add_internal(self):
         for cg in self.cgs:
-            oldidx2newidx = {}
             name = cg['product']
             version = cg['version']
             package = name + ':' + version
             self.pkg2cg = cg
             internal_modules = cg['modules']['internal']
+            # XXX: Old indices are small and dense, so map them through a flat
+            #      int array indexed by old idx (-1 for gaps) instead of a dict.
+            max_oldidx = max((int(kn) for vm in internal_modules.values() for kn in vm['namespaces']), default=-1)
+            oldidx2newidx = array.array('i', [-1]) * (max_oldidx + 1)
+            first_newidx = self.next_index
             for km, vm in internal_modules.items():
                 for kn, vn in vm['namespaces'].items():
                     oldidx = int(kn)
@@ -181,7 +249,7 @@ class MyStitcher():
                     newname = ns.replace('/', '.').lstrip('.').rstrip('.').removesuffix('()')
 
                     newmetadata = {'package': package}
-                    if 'bridges' in meta.keys():
+                    if 'bridges' in meta:
                         newmetadata['bridges'] = meta['bridges']
                     else:
                         newmetadata['bridges'] = None
@@ -193,41 +261,46 @@ class MyStitcher():
                     self.n2idx[newname] = newidx
                     oldidx2newidx[oldidx] = newidx
 
-            internal_calls = cg["graph"]["internalCalls"]
-            for call in internal_calls:
-                src = int(call[0])
-                dst = int(call[1])
-                newsrc = oldidx2newidx[src]
-                newdst = oldidx2newidx[dst]
-                self.final_edges.append([newsrc, newdst])
-                dstname = self.idx2n[newdst]
-                dst_name_init = dstname + '.__init__'
-                dst_init = self.n2idx.get(dst_name_init, None)
-                if dst_init is not None:
-                    log.debug(f'Also added edge to __init__ for {dstname}')
-                    self.final_edges.append([newsrc, dst_init])
+            # XXX: Every internal call src -> dst is followed by an edge
+            #      src -> dst.__init__ when such a node exists. Look the
+            #      __init__ nodes up once per node instead of once per call.
+            init_of = [self.n2idx.get(self.idx2n[i] + '.__init__', -1)
+                       for i in range(first_newidx, self.next_index)]
+
+            append = self.final_edges.append
+            num_init_edges = 0
+            # FASTEN calls are [src, dst, {metadata}], with string ids
+            for call in cg["graph"]["internalCalls"]:
+                newsrc = oldidx2newidx[int(call[0])]
+                newdst = oldidx2newidx[int(call[1])]
+                if newsrc < 0 or newdst < 0:
+                    raise KeyError(f'Edge {call} of {package} refers to a missing internal node')
+                append(newsrc, newdst)
+                init = init_of[newdst - first_newidx]
+                if init >= 0:
+                    append(newsrc, init)
+                    num_init_edges += 1
+            log.debug('Also added %d edges to __init__ for %s', num_init_edges, package)
 
             self.old2new[package] = oldidx2newidx
 
     def try_import(self, name):
         pairs = get_import_name_pairs(name)
-        log.debug(f'import pairs = {pairs}')
+        log.debug('import pairs = %s', pairs)
         found = None
-        for m, rest in pairs:
-            obj = None
-            module = None
+        # XXX: Longest module prefix first. Names mostly point into a
+        #      submodule, so this usually succeeds on the first import
+        #      instead of after a failed getattr() on each parent package.
+        for m, rest in reversed(pairs):
             success = True
             babushka = rest.split('.')
-            try:
-                module = importlib.import_module(m)
-            except Exception as e:
-                success = False
-                log.debug(e)
+            module = cached_import(m)
+            if module is None:
                 continue
             obj = module
             for o in babushka:
                 try:
-                    log.debug(f'getattr(m, {o})')
+                    log.debug('getattr(m, %s)', o)
                     obj = getattr(obj, o)
                 except Exception as e:
                     success = False
@@ -240,24 +313,36 @@ class MyStitcher():
 
 
     def pyname_to_fqn(self, pyname):
+        if self.known_toplevels is not None and pyname.split('.', 1)[0] not in self.known_toplevels:
+            log.debug('Top-level module of %s is not in the sysdir', pyname)
+            return None
+
         obj = self.try_import(pyname)
         if obj is None:
-            log.debug(f'No object found for external pyname {pyname}')
+            log.debug('No object found for external pyname %s', pyname)
             return None
 
-        mod = inspect.getmodule(obj)
+        # XXX: inspect.getmodule() may realpath() the __file__ of every loaded
+        #      module. Try the module named by the object itself first.
+        if inspect.ismodule(obj):
+            mod = obj
+        else:
+            objmod = getattr(obj, '__module__', None)
+            mod = sys.modules.get(objmod) if isinstance(objmod, str) else None
+            if mod is None:
+                mod = inspect.getmodule(obj)
         if mod is None:
-            log.debug(f'None inspect.getmodule({pyname})')
+            log.debug('None inspect.getmodule(%s)', pyname)
             return None
 
         mod_path = getattr(mod, '__file__', None)
         if mod_path is None:
-            log.debug(f'No __file__ for module returned by inspect.getmodule({pyname})')
+            log.debug('No __file__ for module returned by inspect.getmodule(%s)', pyname)
             return None
 
         qualname = getattr(obj, '__qualname__', None)
         if qualname is None:
-            log.debug(f'No __qualname__ attribute for pyname {pyname}. Falling back to last name after dot.')
+            log.debug('No __qualname__ attribute for pyname %s. Falling back to last name after dot.', pyname)
             qualname = pyname.split('.')[-1]
 
         modname = mod_path_to_fqn(mod_path, self.sysdir_path)
@@ -278,6 +363,10 @@ class MyStitcher():
             oldidx2extname = {}
             blacklist = set()
             external_modules = cg['modules']['external']
+            old2new = self.old2new[package]
+            n2idx = self.n2idx
+            n2fqn = self.n2fqn
+            final_edges = self.final_edges
             log.info(package)
             for km, vm in external_modules.items():
                 for kn, vn in vm['namespaces'].items():
@@ -285,15 +374,12 @@ class MyStitcher():
                     ns = vn['namespace']
                     extname = ns.split("//")[-1]
                     if (ns.startswith('//.builtin')
-                        or any([extname.startswith(m) for m in STD_MODULE_PREFIXES])
-                        or any([pref in extname for pref in BUGGY_PREFIXES])):
+                        or is_std_name(extname)
+                        or BUGGY_RE.search(extname)):
                         blacklist.add(oldidx)
-                        log.debug(f'Added ns {ns} to blacklist')
+                        log.debug('Added ns %s to blacklist', ns)
 
-                    possible_names = []
-                    possible_names.append(extname)
-                    possible_names.extend([ extname.removesuffix(s) for s in STR_METHOD_SUFFIXES if extname.removesuffix(s) not in possible_names])
-                    oldidx2extname[oldidx] = possible_names
+                    oldidx2extname[oldidx] = candidate_names(extname)
 
             external_calls = cg["graph"]["externalCalls"]
             count_externals = len(external_calls)
@@ -307,46 +393,52 @@ class MyStitcher():
                     dst = int(call[1])
                 except Exception as e:
                     self.num_None_dst += 1
-                    log.debug(f'Exception {e} when handling edge {call} from CG of package {package}')
+                    log.debug('Exception %s when handling edge %s from CG of package %s', e, call, package)
 
                 if dst in blacklist:
                     self.num_externals_ignored += 1
                     continue
 
-                newsrc = self.old2new[package][src]
+                newsrc = old2new[src]
+                if newsrc < 0:
+                    raise KeyError(f'Edge {call} of {package} refers to a missing internal node')
                 dstnames = oldidx2extname.get(dst, None)
 
                 if dstnames is None:
-                    log.debug(f'No oldidx2extname for idx {dst}')
+                    log.debug('No oldidx2extname for idx %s', dst)
                     continue
 
 
                 found = False
+                # XXX: The stripped names are fallbacks. Only try them when
+                #      the full name finds no node.
                 for dname in dstnames:
+                    if found:
+                        break
                     options = [dname, dname + '.__init__']
 
-                    fqn = self.n2fqn.get(dname, None)
+                    fqn = n2fqn.get(dname, None)
                     if fqn is None:
                         fqn = self.pyname_to_fqn(dname)
                         if fqn is None:
                             fqn = 'NONE'
-                        self.n2fqn[dname] = fqn
+                        n2fqn[dname] = fqn
 
                     if fqn != 'NONE':
-                        log.debug(f'FQN({dname}) = {fqn}')
+                        log.debug('FQN(%s) = %s', dname, fqn)
                         fqns = [fqn, fqn + '.__init__']
                         for f in fqns:
                             if f not in options:
                                 options.append(f)
                     else:
-                        log.debug(f'FQN({dname}) = NONE')
+                        log.debug('FQN(%s) = NONE', dname)
 
 
                     for name in options:
-                        if name in self.n2idx.keys():
-                            log.debug(f'name = {name}, found in internals')
-                            newdst = self.n2idx[name]
-                            self.final_edges.append([newsrc, newdst])
+                        newdst = n2idx.get(name)
+                        if newdst is not None:
+                            log.debug('name = %s, found in internals', name)
+                            final_edges.append(newsrc, newdst)
                             if not found:
                                 found_externals += 1
                                 self.num_externals_found += 1
@@ -354,16 +446,18 @@ class MyStitcher():
 
 
                 if not found:
-                    log.debug(f'No node found for externalCall to {dstnames[0]} from package {package}')
+                    log.debug('No node found for externalCall to %s from package %s', dstnames[0], package)
                     missed_externals += 1
                     self.num_externals_missed += 1
                     unresolved.add(dstnames[0])
-                    self.external_stats[package] = {'total': count_externals,
-                                               'found': found_externals,
-                                               'missed': missed_externals,
-                                               'which_missed': sorted(list(unresolved))}
                     self.pynames_not_found.add(dstnames[0])
 
+            if missed_externals > 0:
+                self.external_stats[package] = {'total': count_externals,
+                                           'found': found_externals,
+                                           'missed': missed_externals,
+                                           'which_missed': sorted(unresolved)}
+
     def stitch(self):
         sys.path.insert(0, self.sysdir_path)
         log.info(f'SYS_PATH = {sys.path}')
@@ -375,22 +469,26 @@ class MyStitcher():
         log.info(f'NUM_EXTERNALS_MISSING = {self.num_externals_missed}')
         log.info(f'NUM_EXTERNALS_IGNORED = {self.num_externals_ignored}')
         log.info(f'NUM_NONE_DST_EDGES = {self.num_None_dst}')
-        log.debug(f'Pynames not found:')
-
-        for n in sorted(list(self.pynames_not_found)):
-            log.debug(n)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('Pynames not found:')
+            for n in sorted(self.pynames_not_found):
+                log.debug(n)
 
         if self.stats_file is None:
             log.info(json.dumps(self.external_stats, indent=2))
         else:
             with open(self.stats_file, 'w') as outfile:
-                outfile.write(json.dumps(self.external_stats, indent=2))
+                json.dump(self.external_stats, outfile, indent=2)
 
         if self.output_file is None:
-            log.info(json.dumps(self.final_cg, indent=2))
+            log.info(json.dumps(self.final_cg, indent=2, default=cgutils.json_default))
         else:
-            with open(self.output_file, 'w') as outfile:
-                outfile.write(json.dumps(self.final_cg, indent=2))
+            if self.pretty:
+                with open(self.output_file, 'w', buffering=1 << 20) as outfile:
+                    json.dump(self.final_cg, outfile, indent=2, default=cgutils.json_default)
+            else:
+                with open(self.output_file, 'wb', buffering=1 << 20) as outfile:
+                    cgutils.stream_dump_graph(self.final_cg, outfile)
 
 
 def main():
@@ -401,7 +499,7 @@ def main():
         log.error(f'No sysdir path provided')
         sys.exit(1)
 
-    stitcher = MyStitcher(args.call_graph_paths, args.toplevel, args.output, args.sysdir, args.statsfile)
+    stitcher = MyStitcher(args.call_graph_paths, args.toplevel, args.output, args.sysdir, args.statsfile, args.pretty)
     stitcher.stitch()
 
 if __name__ == "__main__":
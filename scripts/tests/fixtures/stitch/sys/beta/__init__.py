@@ -0,0 +1 @@
+from .impl import helper
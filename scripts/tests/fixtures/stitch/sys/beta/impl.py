@@ -0,0 +1,14 @@
+def helper():
+    return Klass()
+
+
+def split():
+    pass
+
+
+class Klass:
+    def __init__(self):
+        pass
+
+    def count(self):
+        pass
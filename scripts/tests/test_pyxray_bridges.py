@@ -0,0 +1,68 @@
+import os
+import sys
+import base64
+import hashlib
+import zipfile
+import tempfile
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pyxray_bridges
+
+
+def make_wheel(wheel_dir, name, version, files):
+    dist_info = f'{name}-{version}.dist-info'
+    files = dict(files)
+    files[f'{dist_info}/METADATA'] = f'Metadata-Version: 2.1\nName: {name}\nVersion: {version}\n'
+    files[f'{dist_info}/WHEEL'] = 'Wheel-Version: 1.0\nGenerator: test\nRoot-Is-Purelib: true\nTag: py3-none-any\n'
+    record = []
+    for path, content in files.items():
+        digest = base64.urlsafe_b64encode(hashlib.sha256(content.encode()).digest()).rstrip(b'=').decode()
+        record.append(f'{path},sha256={digest},{len(content)}')
+    record.append(f'{dist_info}/RECORD,,')
+    files[f'{dist_info}/RECORD'] = '\n'.join(record) + '\n'
+    with zipfile.ZipFile(os.path.join(wheel_dir, f'{name}-{version}-py3-none-any.whl'), 'w') as zf:
+        for path, content in files.items():
+            zf.writestr(path, content)
+
+
+class InstallToplevelBatchTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.wheel_dir = os.path.join(self.tmp.name, 'wheels')
+        self.install_root = os.path.join(self.tmp.name, 'install')
+        os.makedirs(self.wheel_dir)
+        os.makedirs(self.install_root)
+        # pkga and pkgb both ship a top-level tests/__init__.py, pkgc does not
+        make_wheel(self.wheel_dir, 'pkga', '1.0', {'pkga/__init__.py': 'A = 1\n', 'tests/__init__.py': 'WHO = "a"\n'})
+        make_wheel(self.wheel_dir, 'pkgb', '1.0', {'pkgb/__init__.py': 'B = 1\n', 'tests/__init__.py': 'WHO = "b"\n'})
+        make_wheel(self.wheel_dir, 'pkgc', '1.0', {'pkgc/__init__.py': 'C = 1\n'})
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def fullsbs(self, package, version):
+        return SimpleNamespace(
+            package=package,
+            version=version,
+            tmp_install_dir_root=self.install_root,
+            tmp_install_dir_toplevel=os.path.join(self.install_root, f'{package}___{version}___TOPLEVEL'),
+        )
+
+    def test_shared_paths_fall_back_to_per_package_installs(self):
+        batch = [self.fullsbs(p, '1.0') for p in ('pkga', 'pkgb', 'pkgc')]
+        env = {'PIP_NO_INDEX': '1', 'PIP_FIND_LINKS': self.wheel_dir, 'PIP_DISABLE_PIP_VERSION_CHECK': '1'}
+        with mock.patch.dict(os.environ, env):
+            ready = pyxray_bridges.install_toplevel_batch(batch)
+
+        self.assertEqual(ready, {'pkgc:1.0'})
+        self.assertFalse(os.path.exists(batch[0].tmp_install_dir_toplevel))
+        self.assertFalse(os.path.exists(batch[1].tmp_install_dir_toplevel))
+        self.assertTrue(os.path.exists(os.path.join(batch[2].tmp_install_dir_toplevel, 'pkgc', '__init__.py')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+import os
+import sys
+import json
+import tempfile
+import unittest
+import subprocess as sp
+
+SCRIPTS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES_DIR = os.path.join(SCRIPTS_DIR, 'tests', 'fixtures', 'stitch')
+
+
+class StitchTest(unittest.TestCase):
+    # XXX: stitch.py imports the analyzed packages, so run it in a fresh
+    #      interpreter as the pipeline does. The sysdir ships a stand-in numpy
+    #      to catch stitch.py importing the real one itself.
+    def stitch(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            output = os.path.join(tmp, 'stitched.json')
+            cmd = [
+                sys.executable, os.path.join(SCRIPTS_DIR, 'stitch.py'),
+                '-s', os.path.join(FIXTURES_DIR, 'sys'),
+                '-o', output,
+                '-l', 'warning',
+                os.path.join(FIXTURES_DIR, 'alpha.cg.json'),
+                os.path.join(FIXTURES_DIR, 'beta.cg.json'),
+                os.path.join(FIXTURES_DIR, 'numpy.cg.json'),
+            ]
+            sp.run(cmd, check=True, cwd=tmp)
+            with open(output, 'r') as infile:
+                return json.load(infile)
+
+    def stitched_edges(self):
+        cg = self.stitch()
+        names = {int(k): v['URI'] for k, v in cg['nodes'].items()}
+        return cg['edges'], {(names[src], names[dst]) for src, dst in cg['edges']}
+
+    def test_fasten_calls(self):
+        raw_edges, edges = self.stitched_edges()
+        self.assertEqual(edges, {
+            ('alpha.main', 'alpha.main.run'),
+            ('alpha.main.run', 'alpha.main.Widget'),
+            ('alpha.main.run', 'alpha.main.Widget.__init__'),
+            ('alpha.main.run', 'beta.impl.helper'),
+            ('alpha.main.run', 'beta.impl.split'),
+            ('alpha.main.run', 'beta.impl.Klass.count'),
+            ('alpha.main.run', 'numpy.core.thing'),
+            ('beta.impl.helper', 'beta.impl.Klass'),
+            ('beta.impl.helper', 'beta.impl.Klass.__init__'),
+        })
+        self.assertEqual(len(edges), len(raw_edges))
+
+    def test_str_method_names(self):
+        # XXX: beta.impl.split and Klass.count resolve as they are. The names
+        #      with the str method stripped (beta.impl, Klass) must not get
+        #      edges of their own.
+        _, edges = self.stitched_edges()
+        targets = {dst for src, dst in edges if src == 'alpha.main.run' and dst.startswith('beta.')}
+        self.assertEqual(targets, {'beta.impl.helper', 'beta.impl.split', 'beta.impl.Klass.count'})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,7 +2,9 @@ import sys
 import json
 import argparse
 import logging
-from collections import defaultdict
+import numpy as np
+
+import utils
 
 log = logging.getLogger(__name__)
 
@@ -51,6 +53,12 @@ def parse_args():
         default=None,
         help=("Output file."),
     )
+    p.add_argument(
+        "--pretty",
+        default=False,
+        action='store_true',
+        help=("Indent the output callgraph for human inspection."),
+    )
     return p.parse_args()
 
 
@@ -64,102 +72,156 @@ class Unifier():
         self.next_index = 0
         self.hops = []
         self.final_nodes = {}
-        self.final_edges = []
+        self.final_edges = utils.EdgeArray(unique=True)
         self.seen_names = set()
         self.n2idx = {}
         self.idx2n = {}
         self.libs_reparse = set()
 
-        self.egress_per_name_per_lib = defaultdict(dict)
+        # XXX: Egress table as sparse (node idx, lib column, value) entries,
+        #      one chunk per SOCG or bridge batch. As with the nested dicts it
+        #      replaces, a later entry for the same (node, lib) overrides the
+        #      value but keeps the position of the first one.
+        self.libs = []
+        self.lib2col = {}
+        self.egress_rows = []
+        self.egress_cols = []
+        self.egress_vals = []
+        self.num_socg_nodes = 0
 
     def get_and_bump_idx(self):
         ret = self.next_index
         self.next_index += 1
         return ret
 
+    def lib_col(self, library):
+        col = self.lib2col.get(library)
+        if col is None:
+            col = len(self.libs)
+            self.libs.append(library)
+            self.lib2col[library] = col
+        return col
+
     def load_pycg(self):
-        with open(self.pycg_file, 'r') as infile:
-            cg = json.loads(infile.read())
+        cg = utils.load_json(self.pycg_file)
         self.pycg_edges = cg['edges']
         self.pycg_nodes = cg['nodes']
 
     def load_socgs(self):
-        for f in self.socg_files:
-            with open(f, 'r') as infile:
-                socg_raw = json.loads(infile.read())
+        n2idx = self.n2idx
+        idx2n = self.idx2n
+        for f, socg_raw in utils.iter_load_json(self.socg_files):
             nodes = socg_raw['nodes']
             library = socg_raw['library']
 
-            old2new = {}
-
-            for k, v in nodes.items():
+            # XXX: Only the name lookup needs a Python loop. Old indices are
+            #      remapped through a dense array (-1 for gaps), so that the
+            #      edges can be remapped and counted with numpy.
+            newidxs = []
+            for v in nodes.values():
                 name = v['name']
-                if name not in self.n2idx.keys():
+                new_idx = n2idx.get(name)
+                if new_idx is None:
                     new_node = {'name': name, 'library': library}
                     new_idx = self.get_and_bump_idx()
                     self.final_nodes[str(new_idx)] = new_node
-                    self.n2idx[name] = new_idx
-                    self.idx2n[new_idx] = name
-                    old2new[int(k)] = new_idx
-                else:
-                    old2new[int(k)] = self.n2idx[name]
-                self.egress_per_name_per_lib[name][library] = 0
-
-
-            for e in socg_raw['edges']:
-                src = e[0]
-                dst = e[1]
-                newsrc = old2new[src]
-                newdst = old2new[dst]
-                srcname = self.idx2n[newsrc]
-                self.final_edges.append([newsrc, newdst])
-                if library in self.egress_per_name_per_lib[srcname].keys():
-                    self.egress_per_name_per_lib[srcname][library] += 1
-                else:
-                    self.egress_per_name_per_lib[srcname][library] = 1
+                    n2idx[name] = new_idx
+                    idx2n[new_idx] = name
+                newidxs.append(new_idx)
+
+            oldidxs = np.fromiter(map(int, nodes), dtype=np.int64, count=len(nodes))
+            old2new = np.full(int(oldidxs.max()) + 1 if len(oldidxs) else 0, -1, dtype=np.int64)
+            old2new[oldidxs] = newidxs
 
+            edges = old2new[np.asarray(socg_raw['edges'], dtype=np.int64).reshape(-1, 2)]
+            if (edges < 0).any():
+                raise KeyError(f'Edge of {f} refers to a missing node')
+            self.final_edges.extend(edges)
+
+            # Every node of the SOCG gets an entry for its lib, 0 if it has
+            # no outgoing edges here
+            rows = np.unique(np.asarray(newidxs, dtype=np.int64))
+            vals = np.zeros(len(rows), dtype=np.int64)
+            srcs, counts = np.unique(edges[:, 0], return_counts=True)
+            vals[np.searchsorted(rows, srcs)] = counts
+            self.egress_rows.append(rows)
+            self.egress_cols.append(np.full(len(rows), self.lib_col(library), dtype=np.int64))
+            self.egress_vals.append(vals)
+        self.num_socg_nodes = self.next_index
 
     def process_pycg(self):
         old2new = {}
+        n2idx = self.n2idx
+        idx2n = self.idx2n
+        final_nodes = self.final_nodes
+        final_edges = self.final_edges
+        num_socg_nodes = self.num_socg_nodes
+        # SOCG nodes whose name a PyCG node took over in n2idx
+        shadowed = {}
+        bridge_rows = []
+        bridge_cols = []
         for old_idx, node in self.pycg_nodes.items():
             name = node['URI']
             new_node = {'name': name, 'package': node['metadata']['package']}
             new_idx = self.get_and_bump_idx()
-            self.final_nodes[new_idx] = new_node
-            self.n2idx[name] = new_idx
-            self.idx2n[new_idx] = name
+            final_nodes[new_idx] = new_node
+            prev_idx = n2idx.get(name)
+            if prev_idx is not None and prev_idx < num_socg_nodes:
+                shadowed[name] = prev_idx
+            n2idx[name] = new_idx
+            idx2n[new_idx] = name
             old2new[int(old_idx)] = new_idx
             bridges = node['metadata']['bridges']
             if bridges is not None:
                 for b in bridges:
                     hop_name = b['symbol']
                     lib = b['library']
-                    if hop_name in self.n2idx.keys():
-                        hop_idx = self.n2idx[hop_name]
-                        self.final_edges.append([new_idx, hop_idx])
-                        self.egress_per_name_per_lib[hop_name][lib] = -1
+                    if hop_name in n2idx:
+                        hop_idx = n2idx[hop_name]
+                        final_edges.append(new_idx, hop_idx)
+                        if hop_idx >= num_socg_nodes:
+                            hop_idx = shadowed.get(hop_name)
+                        if hop_idx is not None:
+                            bridge_rows.append(hop_idx)
+                            bridge_cols.append(self.lib_col(lib))
                     else:
                         log.warn(f'hop symbol for bridge {b} not found for {self.pycg_file}')
 
+        # Bridged libs get -1, so that they win in decide_final_libs()
+        self.egress_rows.append(np.asarray(bridge_rows, dtype=np.int64))
+        self.egress_cols.append(np.asarray(bridge_cols, dtype=np.int64))
+        self.egress_vals.append(np.full(len(bridge_rows), -1, dtype=np.int64))
+
         for e in self.pycg_edges:
             src = e[0]
             dst = e[1]
             newsrc = old2new[src]
             newdst = old2new[dst]
-            self.final_edges.append([newsrc, newdst])
+            final_edges.append(newsrc, newdst)
 
     def decide_final_libs(self):
-        for idx, node in self.final_nodes.items():
-            if 'library' in node.keys():
-                name = node['name']
-                lib = node['library']
-                sorted_epln = sorted(self.egress_per_name_per_lib[name].items(), key=lambda item: item[1])
-                if sorted_epln[0][1] == -1:
-                    final_library = sorted_epln[0][0]
-                else:
-                    final_library = sorted_epln[-1][0]
-                final_library = sorted_epln[0][0]
-                self.final_nodes[idx]['library'] = final_library
+        # XXX: Each SOCG node goes to the lib with the least egress for it
+        #      (-1 for bridged libs), the first one seen on ties.
+        rows = np.concatenate(self.egress_rows)
+        cols = np.concatenate(self.egress_cols)
+        vals = np.concatenate(self.egress_vals)
+        if len(rows) == 0:
+            return
+        keys = rows * len(self.libs) + cols
+        _, first = np.unique(keys, return_index=True)
+        _, last = np.unique(keys[::-1], return_index=True)
+        last = len(keys) - 1 - last
+        rows = rows[first]
+        cols = cols[first]
+        vals = vals[last]
+        order = np.lexsort((first, vals, rows))
+        rows = rows[order]
+        cols = cols[order]
+        _, best = np.unique(rows, return_index=True)
+        libs = self.libs
+        final_nodes = self.final_nodes
+        for row, col in zip(rows[best].tolist(), cols[best].tolist()):
+            final_nodes[str(row)]['library'] = libs[col]
 
     def unify(self):
         self.load_pycg()
@@ -185,10 +247,13 @@ def main():
     result = unifier.unify()
 
     if output_file is None:
-        log.info(json.dumps(result, indent=2))
+        log.info(json.dumps(result, indent=2, default=utils.json_default))
     else:
-        with open(output_file, 'w') as outfile:
-            outfile.write(json.dumps(result, indent=2))
+        with open(output_file, 'wb', buffering=1 << 20) as outfile:
+            if args.pretty:
+                utils.json_dump(result, outfile)
+            else:
+                utils.stream_dump_graph(result, outfile)
 
 
 if __name__ == "__main__":
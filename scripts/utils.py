@@ -1,11 +1,32 @@
 import os
 import csv
 import json
+import mmap
+import time
+import shutil
+import fcntl
+import contextlib
 import logging
+import tempfile
+import functools
+import itertools
+import collections
+import concurrent.futures
+import threading
 import Levenshtein
 from pathlib import Path
+import cgutils
+from cgutils import EdgeArray, json_default
 import subprocess as sp
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# XXX: Number of callgraph files read and parsed ahead of the code merging them
+LOAD_WORKERS = 16
+
 log = logging.getLogger(__name__)
 
 def load_csv(filename):
@@ -44,8 +65,57 @@ def get_mod_import_name(mod_path, pkg_root_path):
 
     return import_name
 
-def run_cmd(opts, timeout=None, shell=False):
-    cmd = sp.Popen(opts, stdout=sp.PIPE, stderr=sp.PIPE, text=True, shell=shell)
+def json_load(infile):
+    # XXX: orjson parses several times faster than the stdlib json module.
+    #      Open infile in binary mode to spare a utf-8 decode of the whole file.
+    if orjson is not None:
+        return orjson.loads(infile.read())
+    return json.load(infile)
+
+def json_dump(obj, outfile, indent=True):
+    # XXX: outfile must be opened in binary mode
+    if orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        outfile.write(orjson.dumps(obj, default=json_default, option=option))
+    elif indent:
+        outfile.write(json.dumps(obj, indent=2, default=json_default).encode())
+    else:
+        outfile.write(json.dumps(obj, separators=(',', ':'), default=json_default).encode())
+
+def stream_dump_graph(graph, outfile, chunk=1 << 16):
+    # XXX: Produces the same bytes as json_dump(..., indent=False)
+    if orjson is not None:
+        return cgutils.stream_dump_graph(graph, outfile, dumps=orjson.dumps, chunk=chunk)
+    return cgutils.stream_dump_graph(graph, outfile, chunk=chunk)
+
+def load_json(path):
+    # XXX: With orjson, parse straight from a read-only mapping of the file,
+    #      so there is no transient copy of the whole file in memory.
+    with open(path, 'rb') as infile:
+        if orjson is None or os.fstat(infile.fileno()).st_size == 0:
+            return json_load(infile)
+        with mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            with memoryview(mm) as view:
+                return orjson.loads(view)
+
+def iter_load_json(paths):
+    # XXX: Yields (path, parsed) in the order of paths while later files are
+    #      read on a thread pool. At most LOAD_WORKERS files are in flight or
+    #      parsed and waiting, so only that many graphs are held at once.
+    #      Order matters: callers hand out node indices as they merge.
+    paths = iter(paths)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=LOAD_WORKERS) as executor:
+        pending = collections.deque((p, executor.submit(load_json, p)) for p in itertools.islice(paths, LOAD_WORKERS))
+        while pending:
+            path, fut = pending.popleft()
+            yield path, fut.result()
+            for p in itertools.islice(paths, 1):
+                pending.append((p, executor.submit(load_json, p)))
+
+def run_cmd(opts, timeout=None, shell=False, env=None):
+    cmd = sp.Popen(opts, stdout=sp.PIPE, stderr=sp.PIPE, text=True, shell=shell, env=env)
     out, err = cmd.communicate(timeout=None)
     ret = cmd.returncode
     log.debug(opts)
@@ -59,6 +129,116 @@ def create_dir(path):
     if not p.exists():
         p.mkdir(parents=True)
 
+def walk_files(root):
+    # XXX: os.scandir() hands back the d_type readdir() already gave us, so
+    #      unlike Path.rglob() + is_file() there is no extra stat per entry.
+    stack = [root]
+    while stack:
+        try:
+            it = os.scandir(stack.pop())
+        except OSError as e:
+            log.debug(e)
+            continue
+        with it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.is_file():
+                    yield entry
+
+def async_rmtree(path):
+    # XXX: Renaming within the same directory is atomic, so callers can move on
+    #      (or recreate `path`) right away while the tree is deleted in the
+    #      background. Non-daemon thread: the interpreter, and multiprocessing
+    #      workers, wait for it before exiting.
+    trash = f'{path}.trash.{os.getpid()}.{time.time_ns()}'
+    try:
+        os.rename(path, trash)
+    except OSError as e:
+        log.warning(e)
+        shutil.rmtree(path, ignore_errors=True)
+        return
+    threading.Thread(target=shutil.rmtree, args=(trash,), kwargs={'ignore_errors': True}).start()
+
+def purge_trash(root):
+    # XXX: Remove trees left behind by an async_rmtree() that got interrupted
+    if not os.path.isdir(root):
+        return
+    with os.scandir(root) as it:
+        for entry in it:
+            if '.trash.' in entry.name:
+                threading.Thread(target=shutil.rmtree, args=(entry.path,), kwargs={'ignore_errors': True}).start()
+
+def pip_env():
+    # XXX: Skip pip's self version check (a network round trip) and bytecode
+    #      writes of pip's own modules on every invocation.
+    env = dict(os.environ)
+    env['PIP_DISABLE_PIP_VERSION_CHECK'] = '1'
+    env['PYTHONDONTWRITEBYTECODE'] = '1'
+    return env
+
+def download_to_cache(wheel_cache, specs, extra_args):
+    # XXX: The wheel cache is shared by all workers. pip copies into -d in
+    #      place, so download into a private staging dir (reusing what the
+    #      cache already has via --find-links) and move new files over under
+    #      the lock. Installs reading the cache only ever see whole files.
+    os.makedirs(wheel_cache, exist_ok=True)
+    staging = tempfile.mkdtemp(prefix='download_', dir=wheel_cache)
+    try:
+        cmd = [
+            'pip3',
+            'download',
+            '-d', staging,
+            '--find-links', wheel_cache,
+        ]
+        cmd.extend(extra_args)
+        cmd.extend(specs)
+        ret, out, err = run_cmd(cmd, env=pip_env())
+        if ret != 0:
+            log.warning(f"Could not download {specs} to wheel cache {wheel_cache}")
+            log.debug(err)
+            return ret
+
+        with open(os.path.join(wheel_cache, '.lock'), 'w') as lockfile:
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+            for item in os.listdir(staging):
+                dst = os.path.join(wheel_cache, item)
+                if not os.path.exists(dst):
+                    os.replace(os.path.join(staging, item), dst)
+        return 0
+    finally:
+        async_rmtree(staging)
+
+@contextlib.contextmanager
+def locked(path):
+    # XXX: Serializes workers on <path>.lock, e.g. two packages of a run
+    #      that need the same install tree.
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.lock', 'w') as lockfile:
+        fcntl.flock(lockfile, fcntl.LOCK_EX)
+        yield
+
+def download_spec_to_cache(wheel_cache, spec, extra_args):
+    # XXX: The TOPLEVEL and the full install of a package fetch its spec
+    #      concurrently. Serialize them on a per-spec lock so the second one
+    #      finds the files in the cache.
+    with locked(os.path.join(wheel_cache, spec)):
+        return download_to_cache(wheel_cache, [spec], extra_args)
+
+def run_pip_install(cmd, wheel_cache, cached):
+    # XXX: Build backends for sdists may be missing from the cache, so retry
+    #      against the index if the offline install fails.
+    if cached:
+        ret, out, err = run_cmd(cmd + ['--no-index', '--find-links', wheel_cache], env=pip_env())
+        if ret == 0:
+            return ret, out, err
+        log.warning(f"Offline install from {wheel_cache} failed, retrying against the index")
+        log.debug(err)
+    return run_cmd(cmd, env=pip_env())
+
+# XXX: Every pipeline object looks the root up in its constructor. None of the
+#      scripts chdir(), so one walk up from the CWD per process is enough.
+@functools.lru_cache(maxsize=1)
 def find_git_root():
     path = Path.cwd()
     if (path/".git").exists():